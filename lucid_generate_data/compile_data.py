@@ -4,26 +4,54 @@
 #
 
 import json
+import multiprocessing
 import random
 from os import listdir
 from os.path import isfile, join
-from typing import Dict, List, Any
-from utils_compile_data import add_select_system_tags, STRING_REPLACE_CONVERSATION_INTERRUPTED
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
+from utils_compile_data import (
+    add_select_system_tags,
+    find_heldout_intents,
+    get_intent_matcher,
+    load_validation_issues,
+    STRING_REPLACE_CONVERSATION_INTERRUPTED,
+)
+from truncation_rules import (
+    can_keep_without_checkpoint,
+    has_empty_str,
+    is_checkpoint,
+    predicts_hint,
+)
+from utils_deduplicate import Deduplicator
+from validate_with_tags import TAGS_BEFORE_SAY
+from utils_output import JsonArrayWriter, ShardedJsonlWriter
 
 
 ERROR_FOLDER = "lucid_generate_data/validation_issues"
+# The validation checks saved for each issue, as (passed, details)
+ERROR_LAYERS = [
+    "1st llm validation",
+    "2nd llm validation",
+    "cheating llm validation",
+    "tag validation",
+    "only referencing last hint",
+]
 PATH_CONVERSATIONS = "lucid_generate_data/saved_conversations"
 FIX_ERRORS = True
 SPLITS = {"pop": ["train", "dev", "test"], "weights": [0.8, 0.1, 0.1]}
-MIN_TURNS_TO_RETRIEVE_CONVO = 10
-UNHAPPY_PATHS_BEFORE_SAY = [
-    "EARLY_END",
-    "IRRELEVANT",
-    "CANCEL",
-    "SARCASTIC",
-    "DELAY_CONFIRMATION",
-    "OVERHEARD",
-]
+# Exact duplicates are always removed. Set this (e.g. to 0.9) to also remove conversations with
+# .. at least this (estimated) similarity to a kept conversation
+NEAR_DUPLICATE_THRESHOLD = None
+DUPLICATES_REPORT_PATH = "LUCID_duplicates.json"
+# "json" writes a single array to OUTPUT_PATH, "jsonl" writes shards per split to OUTPUT_DIR
+OUTPUT_MODE = "json"
+OUTPUT_PATH = "LUCID_data.json"
+OUTPUT_DIR = "LUCID_data"
+OUTPUT_COMPRESSION = "gzip"  # gzip, zstd (requires zstandard) or None
+OUTPUT_SHARD_SIZE = 100000
+# Conversations are prepared in a pool of this many processes (1 to run serially)
+NUM_WORKERS = 1
+WORKER_CHUNK_SIZE = 16
 
 
 def find_conversations() -> List[str]:
@@ -141,7 +169,7 @@ def identify_predictions_of_hint(conversation: Dict[str, Any]) -> Dict[str, Any]
     """
     for turn in conversation["turns"]:
         if turn["author"] == "System":
-            if "hint" in turn["expression"].lower():
+            if predicts_hint(turn["expression"]):
                 turn["turn_errors"].append("post_processing_hint_prediction")
 
     return conversation
@@ -154,59 +182,17 @@ def identify_empty_str_predictions(conversation: Dict[str, Any]) -> Dict[str, An
 
     for turn in conversation["turns"]:
         if turn["author"] == "System":
-            if '=""' in turn["expression"]:
-                turn["turn_errors"].append("post_processing_empty_str")
-            elif "=''" in turn["expression"]:
+            if has_empty_str(turn["expression"]):
                 turn["turn_errors"].append("post_processing_empty_str")
 
     return conversation
 
 
-def identify_intents_from_list(intent_list: List[str], turn: Dict[str, Any]) -> List[str]:
-    """
-    Identify the intents present in a turn
-    """
-
-    intents_present = []
-
-    for intent in intent_list:
-        if intent in turn["expression"]:
-            intents_present.append(intent)
-
-    return intents_present
-
-
 def get_heldout_intents() -> List[str]:
     """
     We get a list of only our heldout intents
     """
-
-    # We also find our heldout intents
-    mypath = "lucid_v1.0/toolbox_intents_heldout"
-    all_files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-    all_intents = [x.replace(".json", "") for x in all_files]
-
-    return all_intents
-
-
-def find_all_intents_and_query_intents() -> List[str]:
-    """
-    Get all the intents in our toolbox
-    """
-
-    # We find all our intents (minus held out intents)
-    mypath = "lucid_v1.0/toolbox_intents"
-    files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-
-    # We also find our heldout intents
-    mypath = "lucid_v1.0/toolbox_intents_heldout"
-    files_heldout = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-
-    # We outout a list of the intent names
-    all_files = files + files_heldout
-    all_intents = [x.replace(".json", "") for x in all_files]
-
-    return all_intents
+    return find_heldout_intents()
 
 
 def find_all_conversation_intents(conversation: Dict[str, Any]) -> List[str]:
@@ -214,14 +200,14 @@ def find_all_conversation_intents(conversation: Dict[str, Any]) -> List[str]:
     Find all intents in a conversation
     """
 
-    all_intents = find_all_intents_and_query_intents()
+    # We match against all intents at once, rather than scanning for each intent in turn
+    intent_matcher = get_intent_matcher()
 
     intents_included = []
-    query_intents_included = []
 
     for turn in conversation["turns"]:
         if turn["author"] == "System":
-            intents_included += identify_intents_from_list(all_intents, turn)
+            intents_included += intent_matcher.intents_in(turn["expression"])
 
     intents_included = list(set(intents_included))
 
@@ -232,17 +218,24 @@ def append_errors(conversation: Dict[str, Any]) -> Dict[str, Any]:
     """
     Extract any validation errors found in the conversation
     """
-    turn_errors = []
+
+    # We look up all the validation issues in the conversation at once
+    references = [
+        turn["errors"]
+        for turn in conversation["turns"]
+        if turn["author"] == "System" and turn["errors"]
+    ]
+    validation_issues = load_validation_issues(ERROR_FOLDER, references)
 
     for turn in conversation["turns"]:
         turn_errors = []
         if turn["author"] == "System":
             if turn["errors"]:
-                with open(ERROR_FOLDER + "/" + turn["errors"], "r") as f:
-                    error_dict = json.load(f)
+                error_dict = validation_issues[turn["errors"]]
 
                 for error_layer in ERROR_LAYERS:
-                    if error_dict[error_layer][0]:
+                    # Not every check is run for every turn
+                    if error_layer in error_dict and not error_dict[error_layer][0]:
                         turn_errors.append(error_layer)
             turn["turn_errors"] = turn_errors
 
@@ -255,12 +248,8 @@ def search_for_checkpoint(turn: Dict[str, Any], checkpoint_reached: bool) -> boo
     """
 
     # We search for the next checkpoint when we can save the conversation
-    if turn["author"] == "System":
-        if turn["expression"].startswith("find_"):
-            checkpoint_reached = True
-
-    elif turn["author"] == "AutoTurn":
-        if turn["expression"].startswith("perform("):
+    if turn["author"] in ("System", "AutoTurn"):
+        if is_checkpoint(turn["author"], turn["expression"]):
             checkpoint_reached = True
 
     return checkpoint_reached
@@ -315,7 +304,7 @@ def truncate_to_avoid_errors(conversation: Dict[str, Any]) -> (Dict[str, Any], b
     if (
         index_of_last_good_turn == 0
         and errors_present
-        and user_turns_before_error > MIN_TURNS_TO_RETRIEVE_CONVO
+        and can_keep_without_checkpoint(user_turns_before_error)
     ):
         assert conversation["turns"][user_turns_before_error]["author"] == "User"
         conversation["turns"] = conversation["turns"][: user_turns_before_error + 1]
@@ -342,7 +331,7 @@ def check_say_after_specific_unhappy_paths(conversation: Dict[str, Any]) -> bool
     filter_example = False
     for turn in conversation["turns"]:
         if turn["author"] == "System":
-            for tag in UNHAPPY_PATHS_BEFORE_SAY:
+            for tag in TAGS_BEFORE_SAY:
                 if "expression" in turn:
                     if tag.lower() in turn["unhappy_paths"]:
                         if turn["expression"] != "say()":
@@ -372,67 +361,117 @@ def get_split(intents_present: List[str], test_intents: List[str]) -> str:
     return split
 
 
-if __name__ == "__main__":
-    random.seed(42)
-    conversation_files = find_conversations()
+def prepare_conversation(conversation_file: str) -> Optional[Tuple[Dict[str, Any], List[str], bool]]:
+    """
+    The processing of a conversation that does not depend on other conversations (or use random)
 
-    total_system_predictions = {}
-    total_intents_present = {"train": {}, "dev": {}, "test": {}, "test_ood": {}, "exclude": {}}
-    full_conversations = []
-    valid_conversation_idx = 0
+    Returns the conversation, the intents it contains and if it should be filtered for unintended corrections,
+    or None if the conversation can not be used
+    """
+    conversation = extract_conversation(conversation_file)
+    conversation = append_errors(conversation)
 
-    # We reformat conversations, saving appropriate conversations
-    for i, conversation_file in enumerate(conversation_files):
+    # We need to check that the conversation does not contain a question by the user, not followed by a query intent
+    # An analysis of the data has shown this is an area where we see data quality issues
+    conversation = identify_predictions_of_hint(conversation)
+    conversation = identify_empty_str_predictions(conversation)
 
-        conversation = extract_conversation(conversation_file)
-        conversation = append_errors(conversation)
+    # We remove the part of the conversation that contains errors
+    conversation, error_present = truncate_to_avoid_errors(conversation)
 
-        # We need to check that the conversation does not contain a question by the user, not followed by a query intent
-        # An analysis of the data has shown this is an area where we see data quality issues
-        conversation = identify_predictions_of_hint(conversation)
-        conversation = identify_empty_str_predictions(conversation)
+    # We now consider the truncated conversation without errors
+    if not conversation["turns"]:
+        return None
 
-        # We remove the part of the conversation that contains errors
-        conversation, error_present = truncate_to_avoid_errors(conversation)
+    elif error_present:
+        if not FIX_ERRORS:
+            return None
 
-        # We now consider the truncated conversation without errors
-        if not conversation["turns"]:
-            continue
+    conversation = add_select_system_tags(conversation)
+    intents_present = find_all_conversation_intents(conversation)
 
-        elif error_present:
-            if not FIX_ERRORS:
-                continue
+    filter_from_correction_post_processing = check_corrections_intended(conversation)
 
-        conversation = add_select_system_tags(conversation)
-        intents_present = find_all_conversation_intents(conversation)
+    return conversation, intents_present, filter_from_correction_post_processing
 
-        # We have different intents for our OOD test set
-        test_intents = get_heldout_intents()
-        conversation["split"] = get_split(intents_present, test_intents)
 
-        # We save conversations that pass two post-processing checks
-        filter_from_correction_post_processing = check_corrections_intended(conversation)
-        if conversation["turns"] and not filter_from_correction_post_processing:
-            saved_conv = store_conversation(
-                conversation, conversation["split"], valid_conversation_idx
-            )
+def compile_conversations(
+    conversation_files: Iterable[str], num_workers: int = 1
+) -> Iterator[Dict[str, Any]]:
+    """
+    Reformat saved conversations one at a time, yielding those that pass our post-processing checks
+
+    With more than one worker, conversations are prepared in a process pool. Splits and indexes are
+    still assigned here, in file order, so the output is the same as with a single worker
+    """
+    valid_conversation_idx = 0
+
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        prepared_conversations = pool.imap(
+            prepare_conversation, conversation_files, chunksize=WORKER_CHUNK_SIZE
+        )
+    else:
+        pool = None
+        prepared_conversations = map(prepare_conversation, conversation_files)
+
+    try:
+        # We reformat conversations, saving appropriate conversations
+        for prepared in prepared_conversations:
+            if prepared is None:
+                continue
+            conversation, intents_present, filter_from_correction_post_processing = prepared
+
+            # We have different intents for our OOD test set
+            test_intents = get_heldout_intents()
+            conversation["split"] = get_split(intents_present, test_intents)
 
-            filter_from_say_post_processing = check_say_after_specific_unhappy_paths(saved_conv)
+            # We save conversations that pass two post-processing checks
+            if conversation["turns"] and not filter_from_correction_post_processing:
+                saved_conv = store_conversation(
+                    conversation, conversation["split"], valid_conversation_idx
+                )
 
-            if not filter_from_say_post_processing:
-                full_conversations.append(saved_conv)
-                valid_conversation_idx += 1
+                filter_from_say_post_processing = check_say_after_specific_unhappy_paths(saved_conv)
 
-    # We remove duplicates
-    all_turns_checking_for_duplicates = []
-    conversations_no_duplicates = []
-    for conv in full_conversations:
-        if conv["turns"] not in all_turns_checking_for_duplicates:
-            if conv["split"] != "exclude":
-                conversations_no_duplicates.append(conv)
-                all_turns_checking_for_duplicates.append(conv["turns"])
+                if not filter_from_say_post_processing:
+                    yield saved_conv
+                    valid_conversation_idx += 1
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-    print("Total observations:", len(conversations_no_duplicates))
 
-    with open("LUCID_data.json", "w") as json_file:
-        json.dump(conversations_no_duplicates, json_file, indent=4)
+if __name__ == "__main__":
+    random.seed(42)
+    conversation_files = find_conversations()
+
+    if OUTPUT_MODE == "jsonl":
+        writer = ShardedJsonlWriter(OUTPUT_DIR, OUTPUT_COMPRESSION, OUTPUT_SHARD_SIZE)
+    else:
+        writer = JsonArrayWriter(OUTPUT_PATH)
+
+    # We remove exact and near duplicates (excluded conversations are dropped anyway)
+    # .. streaming each conversation through to the output, so memory does not grow with the dataset
+    deduplicator = Deduplicator(near_threshold=NEAR_DUPLICATE_THRESHOLD)
+    compiled_conversations = (
+        conv
+        for conv in compile_conversations(conversation_files, NUM_WORKERS)
+        if conv["split"] != "exclude"
+    )
+    for conversation in deduplicator.deduplicate(compiled_conversations):
+        writer.write(conversation)
+    writer.close()
+
+    duplicates_report = deduplicator.report()
+    print(
+        "Duplicates removed:",
+        duplicates_report["removed_exact"],
+        "exact,",
+        duplicates_report["removed_near"],
+        "near",
+    )
+    with open(DUPLICATES_REPORT_PATH, "w") as json_file:
+        json.dump(duplicates_report, json_file, indent=4)
+
+    print("Total observations:", writer.count)
@@ -3,14 +3,21 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
+import asyncio
 import inspect
 from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Set
 
 import yaml
 
 from lucid_generate_data.stage import Stage, StageExecutionException, stage_factory
+from lucid_generate_data.utils.batch import configure_batch
+from lucid_generate_data.utils.cache import configure_cache
+from lucid_generate_data.utils.checkpoint import Checkpoint, CheckpointStore
+from lucid_generate_data.utils.event_loop import run_sync
+from lucid_generate_data.utils.metrics import metric_labels, timed
+from lucid_generate_data.utils.replay import replay_session
 
 
 @dataclass
@@ -23,6 +30,12 @@ def load_config(config_path: str) -> Dict[str, StageNode]:
     with open(config_path, "r") as rf:
         data = yaml.safe_load(rf)
 
+    # The completion cache and batching are shared by the whole process, so are configured globally
+    if "cache" in data:
+        configure_cache(data["cache"])
+    if "batch" in data:
+        configure_batch(data["batch"])
+
     stages = OrderedDict()
     for stage in data["pipeline"]:
         stage_name = stage["stage"]
@@ -30,26 +43,166 @@ def load_config(config_path: str) -> Dict[str, StageNode]:
         dependency = stage.get("dependency", [])
         stages[stage_name] = StageNode(stage_object=stage_object, dependency=dependency)
 
+    # We fail on dependency cycles before anything is run
+    topological_order(stages)
+
     return stages
 
 
+def _internal_dependencies(stages: Dict[str, StageNode], stage_name: str) -> List[str]:
+    # Dependencies on stages outside of the config are met by the initial trace
+    return [dep for dep in stages[stage_name].dependency if dep in stages]
+
+
+def topological_order(stages: Dict[str, StageNode]) -> List[str]:
+    """
+    Orders the stages so each comes after its dependencies (otherwise keeping the config order)
+    """
+    order: List[str] = []
+    remaining = list(stages)
+    while remaining:
+        ready = [
+            stage_name
+            for stage_name in remaining
+            if all(dep in order for dep in _internal_dependencies(stages, stage_name))
+        ]
+        if not ready:
+            raise StageExecutionException(
+                f"Dependency cycle between stages: {', '.join(remaining)}"
+            )
+        order += ready
+        remaining = [stage_name for stage_name in remaining if stage_name not in ready]
+
+    return order
+
+
+def _required_args(stage_object: Stage) -> List[str]:
+    arg_signatures = inspect.signature(stage_object)
+    return [
+        arg
+        for arg, parameter in arg_signatures.parameters.items()
+        if arg != "self" and parameter.default == inspect.Parameter.empty
+    ]
+
+
+def validate_stage_inputs(stages: Dict[str, StageNode], trace: Dict[str, Any]) -> None:
+    """
+    Checks each stage's inputs are in the trace, or are outputs of stages it depends on
+    """
+    ancestors: Dict[str, Set[str]] = {}
+    for stage_name in topological_order(stages):
+        dependencies = _internal_dependencies(stages, stage_name)
+        ancestors[stage_name] = set(dependencies).union(*(ancestors[dep] for dep in dependencies))
+
+        ancestor_outputs = [stages[dep].stage_object.outputs for dep in ancestors[stage_name]]
+        if not all(ancestor_outputs):
+            # We can't know what stages without declared outputs will provide
+            continue
+
+        available = set(trace).union(*ancestor_outputs)
+        missing = [
+            arg for arg in _required_args(stages[stage_name].stage_object) if arg not in available
+        ]
+        if missing:
+            raise StageExecutionException(
+                f"Inputs {', '.join(missing)} of {stage_name} are not in the trace, "
+                "or provided by the stages it depends on"
+            )
+
+
+def _get_stage_inputs(
+    stage_name: str, stage_object: Stage, trace: Dict[str, Any]
+) -> Dict[str, Any]:
+    arg_signatures = inspect.signature(stage_object)
+
+    stage_inputs = {}
+    for arg in arg_signatures.parameters:
+        if arg == "self":
+            continue
+        if arg_signatures.parameters[arg].default == inspect.Parameter.empty:
+            # Assign value for non-optional args
+            if arg not in trace:
+                raise StageExecutionException(f"Value of {arg} is missing in {stage_name}")
+            stage_inputs[arg] = trace[arg]
+        elif arg in trace:
+            # Assign value for optional args with custom input
+            stage_inputs[arg] = trace[arg]
+
+    return stage_inputs
+
+
+async def _run_stage(
+    stage_name: str, stage_object: Stage, stage_inputs: Dict[str, Any]
+) -> Dict[str, Any]:
+    with timed("stage", stage=stage_name):
+        return await stage_object.call_async(**stage_inputs)
+
+
+async def execute_async(
+    stages: Dict[str, StageNode],
+    trace: Dict[str, Any],
+    checkpoint_store: Optional[CheckpointStore] = None,
+    trace_id: Optional[str] = None,
+) -> None:
+    """
+    Runs each stage once its dependencies have finished, running independent stages concurrently
+
+    With a checkpoint store, the trace is saved after each stage, and stages completed
+    by an earlier run of the same trace id are skipped
+    """
+    order = topological_order(stages)
+
+    # Stages can take the trace id as an input (e.g. to save validation issues under it)
+    trace_id = trace_id or trace.get("seed")
+    if trace_id is not None:
+        trace["trace_id"] = trace_id
+
+    completed: List[str] = []
+    if checkpoint_store is not None:
+        assert trace_id is not None
+        checkpoint = checkpoint_store.load(trace_id)
+        if checkpoint is not None:
+            trace.update(checkpoint.trace)
+            completed = [name for name in checkpoint.completed_stages if name in stages]
+
+    validate_stage_inputs(stages, trace)
+
+    waiting_on = {
+        stage_name: set(_internal_dependencies(stages, stage_name)).difference(completed)
+        for stage_name in order
+        if stage_name not in completed
+    }
+    running: Dict[asyncio.Task, str] = {}
+
+    # Recorded LLM completions are replayed per trace, keyed by the trace's seed
+    with replay_session(seed=trace.get("seed")), metric_labels(trace_id=trace_id), timed("trace"):
+        try:
+            while waiting_on or running:
+                for stage_name in [name for name in order if waiting_on.get(name) == set()]:
+                    del waiting_on[stage_name]
+                    stage_object = stages[stage_name].stage_object
+                    stage_inputs = _get_stage_inputs(stage_name, stage_object, trace)
+                    task = asyncio.ensure_future(_run_stage(stage_name, stage_object, stage_inputs))
+                    running[task] = stage_name
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+                # Outputs are added in config order, for when stages finish together
+                for task in sorted(done, key=lambda task: order.index(running[task])):
+                    stage_name = running.pop(task)
+                    trace.update(task.result())
+                    for dependencies in waiting_on.values():
+                        dependencies.discard(stage_name)
+
+                    completed.append(stage_name)
+                    if checkpoint_store is not None:
+                        checkpoint_store.save(
+                            trace_id, Checkpoint(trace=trace, completed_stages=completed)
+                        )
+        finally:
+            for task in running:
+                task.cancel()
+
+
 def execute(stages: Dict[str, StageNode], trace: Dict[str, Any]) -> None:
-    for stage_name, stage_node in stages.items():
-        stage_object = stage_node.stage_object
-        arg_signatures = inspect.signature(stage_object)
-
-        stage_inputs = {}
-        for arg in arg_signatures.parameters:
-            if arg == "self":
-                continue
-            if arg_signatures.parameters[arg].default == inspect.Parameter.empty:
-                # Assign value for non-optional args
-                if arg not in trace:
-                    raise StageExecutionException(f"Value of {arg} is missing in {stage_name}")
-                stage_inputs[arg] = trace[arg]
-            elif arg in trace:
-                # Assign value for optional args with custom input
-                stage_inputs[arg] = trace[arg]
-
-        stage_outputs = stage_object(**stage_inputs)
-        trace.update(stage_outputs)
+    run_sync(execute_async(stages, trace))
@@ -3,7 +3,6 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
-import asyncio
 import subprocess
 from typing import Any, Sequence
 
@@ -12,6 +11,7 @@ import rich
 from rich.prompt import Prompt as TerminalPrompt
 
 from lucid_generate_data.utils.completer import Completer, Prompt
+from lucid_generate_data.utils.event_loop import run_sync
 from lucid_generate_data.utils.definitions import (
     ActionResult,
     Inform,
@@ -104,7 +104,7 @@ def add_user_turn(turns: list[Turn], scenario: list[UserTurn]) -> list[Turn]:
     return turns
 
 
-def generate_response(
+async def generate_response_async(
     turns: list[Turn],
     prompt_template: Environment,
     completer: Completer,
@@ -119,8 +119,22 @@ def generate_response(
     )
     prompt = Prompt(prefix=prefix, stop_texts=["user:", "\n"])
 
-    completion = asyncio.run(completer.complete(prompt))
+    completion = await completer.complete(prompt, stage_name="demo_response")
 
     lucid_turn = LucidTurn(completion.strip())
     turns.append(lucid_turn)
     rich.print(f"{LUCID_PREFIX}{lucid_turn.response}")
+
+
+def generate_response(
+    turns: list[Turn],
+    prompt_template: Environment,
+    completer: Completer,
+    revealed_values: list[Any],
+    example_conversations=str,
+):
+    run_sync(
+        generate_response_async(
+            turns, prompt_template, completer, revealed_values, example_conversations
+        )
+    )
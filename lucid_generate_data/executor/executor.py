@@ -21,6 +21,10 @@ from lucid_generate_data.utils.entities import Entity
 from lucid_generate_data.executor.rewrite_commands import RewriteConfirm, RewriteResume
 
 
+# Slot values of these types are checked against the slot types of the intent, before execution
+PRIMITIVE_SLOT_TYPES = (str, int, float, bool)
+
+
 def _var_name(index: int) -> str:
     return f"x{index}"
 
@@ -47,12 +51,68 @@ def _normalise_args(
     return keyword_args
 
 
+# Marks an assignment that did not exist before a change, in the undo journal
+_UNASSIGNED = object()
+
+
+def _object_state(obj: Any) -> Tuple[Dict[str, Any], Optional[set]]:
+    # Lists are appended to in place, so are copied. Everything else is rebound by setattr
+    attributes = {k: list(v) if isinstance(v, list) else v for k, v in vars(obj).items()}
+    fields_set = getattr(obj, "__fields_set__", None)
+    return attributes, set(fields_set) if fields_set is not None else None
+
+
+def _restore_object_state(obj: Any, object_state: Tuple[Dict[str, Any], Optional[set]]) -> None:
+    attributes, fields_set = object_state
+    vars(obj).clear()
+    vars(obj).update(attributes)
+    if fields_set is not None:
+        object.__setattr__(obj, "__fields_set__", fields_set)
+
+
 @dataclass
 class ExecutionState:
     assignments: dict[str, Any] = field(default_factory=dict)
     app_context: dict[str, Any] = field(default_factory=dict)
     completed: set[str] = field(default_factory=set)
     current_recommendation: Optional[Tuple[str, RecommendedAction]] = None
+    # Undo records of every change made through the methods below, so a snapshot of the state
+    # .. is just a position in the journal, and restoring it only undoes the changes since
+    journal: List[Tuple[Any, ...]] = field(default_factory=list, repr=False, compare=False)
+
+    def assign(self, var_name: str, value: Any) -> None:
+        self.journal.append(("assignment", var_name, self.assignments.get(var_name, _UNASSIGNED)))
+        self.assignments[var_name] = value
+
+    def complete(self, var_name: str) -> None:
+        if var_name not in self.completed:
+            self.journal.append(("completed", var_name))
+            self.completed.add(var_name)
+
+    def set_recommendation(self, recommendation: Optional[Tuple[str, RecommendedAction]]) -> None:
+        self.journal.append(("recommendation", self.current_recommendation))
+        self.current_recommendation = recommendation
+
+    def will_modify(self, obj: Any) -> None:
+        """Records an object's attributes, before a command or entity is changed in place."""
+        self.journal.append(("object", obj, _object_state(obj)))
+
+    def undo(self, position: int) -> None:
+        """Undoes the changes recorded after position in the journal."""
+        while len(self.journal) > position:
+            kind, *record = self.journal.pop()
+            if kind == "assignment":
+                var_name, value = record
+                if value is _UNASSIGNED:
+                    del self.assignments[var_name]
+                else:
+                    self.assignments[var_name] = value
+            elif kind == "completed":
+                self.completed.discard(record[0])
+            elif kind == "recommendation":
+                self.current_recommendation = record[0]
+            else:
+                _restore_object_state(*record)
 
     def get_incomplete_tasks(self) -> List[str]:
         return [k for k in self.assignments if k not in self.completed]
@@ -74,6 +134,7 @@ class ExecutionState:
             print("WARNING: A non-existent recommendation was followed")
             return None
         task = self.assignments[self.current_recommendation[0]]
+        self.will_modify(task)
         task.notify_action(self.current_recommendation[1].name)
 
 
@@ -96,13 +157,15 @@ class Call(BaseModel):
         assert command is not None
         recommended_action = command.recommend_action()
         if recommended_action is not None:
-            state.current_recommendation = (self.var_name, recommended_action)
+            state.set_recommendation((self.var_name, recommended_action))
             return ActionResult(recommended_action=recommended_action, index=self.index)
         else:
-            state.current_recommendation = None
+            state.set_recommendation(None)
 
+            # Performing can update the command (e.g. queries keep the entities found)
+            state.will_modify(command)
             result = ActionResult(result=command.perform(state.app_context), index=self.index)
-            state.completed.add(self.var_name)
+            state.complete(self.var_name)
             return result
 
 
@@ -112,7 +175,7 @@ class CommandCall(Call):
 
     def _run(self, state: ExecutionState) -> ActionResult:
         if not self.assigned:
-            state.assignments[self.var_name] = self.command
+            state.assign(self.var_name, self.command)
         return self._perform_or_recommend(state, self.command)
 
 
@@ -122,7 +185,7 @@ class PerformCall(Call):
     def _run(self, state: ExecutionState) -> ActionResult:
         if self.entity is not None:
             # Provides access to entity x2 in x2 = perform(x1)
-            state.assignments[self.var_name] = self.entity
+            state.assign(self.var_name, self.entity)
         return ActionResult(index=self.index)
 
 
@@ -134,6 +197,7 @@ class AssignmentCall(Call):
     def _run(self, state: ExecutionState) -> ActionResult:
         for att, ndx, val in zip(self.attribute_name, self.idx, self.value):
             command = state.get_assignment(self.var_name, ndx)
+            state.will_modify(command)
             setattr(command, att, val)
 
         return self._perform_or_recommend(state, command)
@@ -147,6 +211,7 @@ class AppendCall(Call):
         command = state.get_assignment(self.var_name)
         list_field = getattr(command, self.attribute_name, None)
         assert isinstance(list_field, list)
+        state.will_modify(command)
         list_field.append(self.value)
 
         return self._perform_or_recommend(state, command)
@@ -159,11 +224,123 @@ class Value(Call):
         return ActionResult(result=self.value, index=self.index)
 
 
+@dataclass
+class ExecutorSnapshot:
+    # The length of the state's journal, and its last record (to check it was not undone since)
+    position: int
+    last_record: Optional[Tuple[Any, ...]]
+    last_result: Optional[ActionResult]
+
+
 @dataclass
 class ProgramExecutor:
     registry: CommandRegistry
-    state: ExecutionState = ExecutionState()
+    state: ExecutionState = field(default_factory=ExecutionState)
     rewrites: Tuple[ast.NodeTransformer, ...] = (RewriteConfirm(), RewriteResume())
+    # Result of the most recently executed turn, so callers can continue from it
+    last_result: Optional[ActionResult] = None
+
+    def snapshot(self) -> ExecutorSnapshot:
+        """Marks the execution state, so that it can be restored if later turns are discarded.
+
+        Nothing is copied: restoring undoes the changes made since, from the state's journal.
+        """
+        journal = self.state.journal
+        return ExecutorSnapshot(
+            position=len(journal),
+            last_record=journal[-1] if journal else None,
+            last_result=self.last_result,
+        )
+
+    def restore(self, snapshot: ExecutorSnapshot) -> None:
+        """Rolls the execution state back to a snapshot (which can be restored again later)."""
+        journal = self.state.journal
+        if len(journal) < snapshot.position or (
+            snapshot.position and journal[snapshot.position - 1] is not snapshot.last_record
+        ):
+            raise ValueError("Cannot restore a snapshot taken after a state that was rolled back")
+
+        self.state.undo(snapshot.position)
+        self.last_result = snapshot.last_result
+
+    def pre_validate(self, turn: ProgramTurn) -> Optional[str]:
+        """
+        Cheaply checks a candidate turn can be executed, returning the reason it can't (or None)
+
+        The turn is parsed, its slot values are type checked, and it is executed on the current
+        state, which is then restored
+        """
+        try:
+            turn_ast, _ = self._parse_program_turn(turn)
+        except (AssertionError, SyntaxError, ValueError) as e:
+            return f"Could not parse {turn.expression}: {e}"
+
+        slot_type_error = self._check_slot_types(self.rewrite_ast(turn_ast))
+        if slot_type_error is not None:
+            return slot_type_error
+
+        snapshot = self.snapshot()
+        try:
+            self.execute_turn(turn)
+        except Exception as e:
+            return f"Could not execute {turn.expression}: {e}"
+        finally:
+            self.restore(snapshot)
+
+        return None
+
+    def _check_slot_types(self, turn_ast: ast.Module) -> Optional[str]:
+        slots: List[Tuple[Type[Any], str, ast.expr]] = []
+        for node in ast.walk(turn_ast):
+            match node:
+                # e.g. set_timer(duration='10 minutes')
+                case ast.Call(func=ast.Name(id=command_name), keywords=keywords):
+                    command_builder = self.registry.commands.get(command_name)
+                    if command_builder is None:
+                        return f"{command_name} is not registered"
+                    slots += [
+                        (command_builder, keyword.arg, keyword.value)
+                        for keyword in keywords
+                        if keyword.arg is not None
+                    ]
+                # e.g. x0.duration, x0.label = '10 minutes', 'noodles'
+                case ast.Assign(targets=[target], value=value):
+                    targets = target.elts if isinstance(target, ast.Tuple) else [target]
+                    values = value.elts if isinstance(value, ast.Tuple) else [value]
+                    for target, value in zip(targets, values):
+                        if isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name):
+                            var_type = type(self.state.assignments.get(target.value.id))
+                            slots.append((var_type, target.attr, value))
+
+        for command_type, slot, value in slots:
+            error = self._check_slot_type(command_type, slot, value)
+            if error is not None:
+                return error
+
+        return None
+
+    @staticmethod
+    def _check_slot_type(command_type: Type[Any], slot: str, value: ast.expr) -> Optional[str]:
+        fields = getattr(command_type, "__fields__", None)
+        if fields is None:
+            # e.g. an entity found by a query, or a variable that is not assigned yet
+            return None
+        if slot not in fields:
+            return f"{slot} is not a slot of {command_type.__name__}"
+
+        slot_type = fields[slot].type_
+        if not isinstance(value, ast.Constant) or value.value is None:
+            return None
+        if slot_type not in PRIMITIVE_SLOT_TYPES or not isinstance(value.value, PRIMITIVE_SLOT_TYPES):
+            return None
+
+        # bool is a subclass of int, and ints are valid floats
+        if isinstance(value.value, bool) != (slot_type is bool) or not (
+            isinstance(value.value, slot_type) or (slot_type is float and isinstance(value.value, int))
+        ):
+            return f"{slot} of {command_type.__name__} should be {slot_type.__name__}, not {value.value!r}"
+
+        return None
 
     def execute_program(self, turns: List[ProgramTurn]) -> None:
         for turn in turns:
@@ -194,6 +371,7 @@ class ProgramExecutor:
         turn_ast = self.rewrite_ast(turn_ast)
         call = self._get_call(turn.index, turn_ast)
         result = call.run(self.state, recommendation_followed)
+        self.last_result = result
 
         return result
 
@@ -8,9 +8,10 @@ from typing import List
 
 from jinja2 import Environment
 
-from lucid_generate_data.openai_call import make_openai_call
+from lucid_generate_data.openai_call import make_openai_call_async
 from lucid_generate_data.utils.definitions import UserTurn
 from lucid_generate_data.stage import StageExecutionException
+from lucid_generate_data.utils.event_loop import run_sync
 
 environment = Environment()
 
@@ -84,7 +85,7 @@ def check_str_responses_said_by_user(with_slots: str, user_string: str):
     return True, None
 
 
-def generate_slot_values(input_turns: list, system_response: str):
+async def generate_slot_values_async(input_turns: list, system_response: str):
     """
     Populates string slot values
     """
@@ -102,6 +103,10 @@ def generate_slot_values(input_turns: list, system_response: str):
     if user_utterance is None:
         raise StageExecutionException("Invalid slot values")
 
-    with_slots = make_openai_call("get_slot_values", prompt=prompt)
+    with_slots = await make_openai_call_async("get_slot_values", prompt=prompt)
 
     return with_slots
+
+
+def generate_slot_values(input_turns: list, system_response: str):
+    return run_sync(generate_slot_values_async(input_turns, system_response))
@@ -3,11 +3,10 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
-from copy import deepcopy
+import asyncio
 from dataclasses import dataclass
 from textwrap import dedent
-from typing import List, Dict, Any
-import json
+from typing import Any, Coroutine, Dict, List, Optional, Tuple
 
 import rich
 from jinja2 import Environment
@@ -16,29 +15,36 @@ from rich.markup import escape
 from rich.panel import Panel
 from rich.syntax import Syntax
 
-import os
-from os import listdir
-from os.path import isfile, join
-
 from lucid_generate_data.utils.completer import OpenAiChatCompleter, Prompt
 
 from lucid_generate_data.validate_with_tags import validation_from_tags
 
-from lucid_generate_data.generate_str_slot_values import generate_slot_values
-from lucid_generate_data.modelling_constants import STAGE_MODEL_LOOKUP
+from lucid_generate_data.generate_str_slot_values import generate_slot_values_async
 from lucid_generate_data.openai_call import (
-    completer_with_llm_validation,
-    completer_with_llm_cheating,
-    completer_no_slot_values,
+    completer_self_consistency_async,
+    completer_with_llm_validation_async,
+    completer_with_llm_cheating_async,
+    completer_no_slot_values_async,
+    get_stage_completer,
+    resolve_sampled_validations,
 )
 from lucid_generate_data.stage import StageExecutionException
-from lucid_generate_data.utils.definitions import ActionResult, InformList, ProgramTurn, Turn
+from lucid_generate_data.utils.definitions import (
+    ActionResult,
+    InformList,
+    ProgramTurn,
+    Transcript,
+    Turn,
+)
+from lucid_generate_data.utils.event_loop import run_sync
+from lucid_generate_data.utils.metrics import record, timed
+from lucid_generate_data.utils.validation_store import get_validation_store
 
 from lucid_generate_data.executor.demo import (
     _recommendation_turn,
     _result_turn,
     conversation_to_text,
-    generate_response,
+    generate_response_async,
     max_turn_index,
 )
 from lucid_generate_data.executor.executor import ProgramExecutor
@@ -51,6 +57,10 @@ STOP_ON_ERROR = False
 NO_TRIES_TO_AVOID_INVALID_COMMANDS = 10
 VALIDATION_FOLDER = "lucid_generate_data/validation_issues/"
 NUM_GENERATION_ATTEMPTS = 3
+SHORT_CIRCUIT_VALIDATION = True  # Only used with STOP_ON_ERROR
+# Sample the LLM validations with the main prediction, in one request (rather than one request each)
+SELF_CONSISTENCY_VALIDATION = True
+LLM_VALIDATION_NAMES = ("1st llm validation", "2nd llm validation")
 
 prompt_template = environment.from_string(
     dedent(
@@ -129,7 +139,44 @@ def ref_last_hint_only(index: int, original_response_with_slots: str):
     )
 
 
-def perform_validation(
+async def _run_llm_validators(
+    validators: Dict[str, Coroutine[Any, Any, Tuple[bool, Optional[str]]]],
+    short_circuit: bool,
+    already_failed: bool,
+) -> Dict[str, Tuple[bool, Optional[str]]]:
+    """
+    Run the validators concurrently. When short-circuiting, outstanding validators are
+    cancelled as soon as any validation has failed
+    """
+    results = {}
+
+    if short_circuit and already_failed:
+        for validator in validators.values():
+            validator.close()
+    else:
+        tasks = {asyncio.ensure_future(validator): name for name, validator in validators.items()}
+
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results[tasks[task]] = task.result()
+
+                if short_circuit and any(not result[0] for result in results.values()):
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # We keep the validators in their original order, noting any that were not run
+    return {
+        name: results.get(name, (True, "Not run, as another validation had already failed"))
+        for name in validators
+    }
+
+
+async def perform_validation_async(
     first_system_turn: bool,
     original_response: str,
     original_response_with_slots: str,
@@ -140,51 +187,55 @@ def perform_validation(
     conversation_rules: str,
     tags_extracted: list,
     last_turn,
+    turn_index: Optional[int] = None,
+    validation_samples: Optional[List[str]] = None,
+    trace_id: Optional[str] = None,
 ) -> str:
 
-    error_dict = {}
-    error_checks = []
+    # The cheap checks are done first, as they can make the LLM validators unnecessary
+    cheap_checks = {
+        "tag validation": validation_from_tags(
+            first_system_turn, original_response_with_slots, tags_extracted
+        )
+    }
 
-    error_dict.update(
-        {
-            "1st llm validation": completer_with_llm_validation(
-                first_system_turn, prompt, completer, original_response, conversation_rules
-            )
-        }
-    )
+    if not first_system_turn:
+        cheap_checks["only referencing last hint"] = ref_last_hint_only(
+            last_turn.index, original_response_with_slots
+        )
 
-    error_dict.update(
-        {
-            "2nd llm validation": completer_with_llm_validation(
-                first_system_turn, prompt, completer, original_response, conversation_rules
+    # Validations sampled with the main prediction only need comparing with it
+    if validation_samples:
+        sampled_checks = dict(
+            zip(
+                LLM_VALIDATION_NAMES,
+                resolve_sampled_validations(original_response, validation_samples),
             )
-        }
-    )
+        )
+        record(
+            "self_consistency",
+            samples=len(sampled_checks),
+            agreed=sum(result[0] for result in sampled_checks.values()),
+        )
+        cheap_checks.update(sampled_checks)
 
-    error_dict.update(
-        {
-            "cheating llm validation": completer_with_llm_cheating(
-                first_system_turn, prompt, completer, conversation_rules, original_response
-            )
-        }
-    )
+    short_circuit = STOP_ON_ERROR and SHORT_CIRCUIT_VALIDATION
+    cheap_check_failed = any(not result[0] for result in cheap_checks.values())
 
-    error_dict.update(
-        {
-            "tag validation": validation_from_tags(
-                first_system_turn, original_response_with_slots, tags_extracted
-            )
-        }
+    # The LLM validators are independent, so are run concurrently
+    llm_validators = {
+        name: completer_with_llm_validation_async(
+            first_system_turn, prompt, completer, original_response, conversation_rules
+        )
+        for name in LLM_VALIDATION_NAMES
+        if name not in cheap_checks
+    }
+    llm_validators["cheating llm validation"] = completer_with_llm_cheating_async(
+        first_system_turn, prompt.copy(), completer, conversation_rules, original_response
     )
 
-    if not first_system_turn:
-        error_dict.update(
-            {
-                "only referencing last hint": ref_last_hint_only(
-                    last_turn.index, original_response_with_slots
-                )
-            }
-        )
+    error_dict = await _run_llm_validators(llm_validators, short_circuit, cheap_check_failed)
+    error_dict.update(cheap_checks)
 
     error_present = False
     for error_type, error_response in error_dict.items():
@@ -192,13 +243,19 @@ def perform_validation(
             print("Error:", error_type, "with details:", error_response)
             error_present = True
 
+    record(
+        "validation",
+        passed=not error_present,
+        failed_checks=[name for name, result in error_dict.items() if not result[0]],
+    )
+
     error_dict["all_turns"] = conversation_to_text(input_turns)
     error_dict["lucid_prediction"] = original_response_with_slots
     error_dict["conversation_rules"] = conversation_rules
     error_dict["intent_definitions"] = intent_definitions
 
     if error_present:
-        file_name = save_validation_results(error_dict)
+        file_name = save_validation_results(error_dict, trace_id, turn_index)
         if STOP_ON_ERROR:
             raise StageExecutionException(
                 "Validation has identified an issue with this turn. Validation result saved in: "
@@ -210,28 +267,47 @@ def perform_validation(
     return file_name
 
 
-def save_validation_results(error_dict: Dict[str, Any]) -> str:
-    mypath = VALIDATION_FOLDER
-    if not os.path.exists(VALIDATION_FOLDER):
-        os.makedirs(VALIDATION_FOLDER)
-
-    all_files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-
-    if all_files:
-        all_file_ints = [int(file[2:-5]) for file in all_files]
-        if all_file_ints:
-            max_error_number = max(all_file_ints)
-        else:
-            max_error_number = 0
-
-        new_file_name = "e." + str(max_error_number + 1) + ".json"
-    else:
-        new_file_name = "e.0.json"
+def perform_validation(
+    first_system_turn: bool,
+    original_response: str,
+    original_response_with_slots: str,
+    prompt: Prompt,
+    completer: OpenAiChatCompleter,
+    input_turns: List[Turn],
+    intent_definitions: List[str],
+    conversation_rules: str,
+    tags_extracted: list,
+    last_turn,
+    turn_index: Optional[int] = None,
+    validation_samples: Optional[List[str]] = None,
+    trace_id: Optional[str] = None,
+) -> str:
+    return run_sync(
+        perform_validation_async(
+            first_system_turn,
+            original_response,
+            original_response_with_slots,
+            prompt,
+            completer,
+            input_turns,
+            intent_definitions,
+            conversation_rules,
+            tags_extracted,
+            last_turn,
+            turn_index,
+            validation_samples,
+            trace_id,
+        )
+    )
 
-    with open(mypath + new_file_name, "w") as json_file:
-        json.dump(error_dict, json_file, indent=4)
 
-    return new_file_name
+def save_validation_results(
+    error_dict: Dict[str, Any], trace_id: Optional[str] = None, turn_index: Optional[int] = None
+) -> str:
+    # Issues are saved under the id of the conversation being generated, so they can be found by turn
+    return get_validation_store(VALIDATION_FOLDER).save(
+        error_dict, trace_id=trace_id, turn_index=turn_index
+    )
 
 
 def _format_examples(list_of_examples: List[str]) -> str:
@@ -245,7 +321,8 @@ def _format_examples(list_of_examples: List[str]) -> str:
     return full_str
 
 
-def generate_system_turn(
+async def _generate_system_turn_async(
+    turns: Transcript,
     input_turns: List[Turn],
     ssa_examples: List[str],
     executor: ProgramExecutor,
@@ -254,26 +331,18 @@ def generate_system_turn(
     conversation_rules: str,
     tags_extracted: List[str],
     special_guidance: str,
+    determined_expression: Optional[str] = None,
+    trace_id: Optional[str] = None,
 ) -> List[Turn]:
-    # Make a copy to account for generation failure
-    turns = deepcopy(input_turns)
     SHOW_PROMPT = True
 
     all_examples_str = _format_examples(ssa_examples)
 
-    completer = OpenAiChatCompleter(
-        model_name=STAGE_MODEL_LOOKUP["lucid_agent"]["model_name"],
-        max_tokens=STAGE_MODEL_LOOKUP["lucid_agent"]["max_tokens"],
-        temperature=STAGE_MODEL_LOOKUP["lucid_agent"]["temperature"],
-    )
-
-    program = [turn for turn in turns if isinstance(turn, ProgramTurn)]
+    completer = get_stage_completer("lucid_agent")
 
+    # The executor carries its state from earlier turns, so we continue from its last result
     next_index = max_turn_index(turns) + 1
-
-    last_value = ActionResult(index=next_index)
-    for turn in program:
-        last_value = executor.execute_turn(turn)
+    last_value = executor.last_result or ActionResult(index=next_index)
 
     num_system_turns = 0
     revealed_values = None
@@ -293,74 +362,129 @@ def generate_system_turn(
             turns.append(new_turn)
             continue
 
-        incomplete = executor.state.get_incomplete_tasks()
+        first_system_turn = num_system_turns == 0
 
-        prefix = prompt_template.render(
-            conversation_text=conversation_to_text(turns),
-            next_index=next_index,
-            incomplete=incomplete,
-            intent_definitions=intent_definitions,
-            confirmation_required=confirmation_required,
-            all_examples=all_examples_str,
-            special_guidance=special_guidance,
-        )
-        prompt = Prompt(prefix=prefix, stop_texts=["user:", "\n"])
+        if determined_expression is not None and first_system_turn:
+            # The user turn's tags fully determine the command, so we skip prediction and validation
+            program_turn = ProgramTurn(index=next_index, expression=determined_expression)
+            last_value = executor.execute_turn(program_turn)
+            record("tag_rule", expression=determined_expression, tags=tags_extracted)
+            rich.print(
+                Columns([str(program_turn.index), Syntax(program_turn.expression, "python")])
+            )
+        else:
+            incomplete = executor.state.get_incomplete_tasks()
+
+            prefix = prompt_template.render(
+                conversation_text=conversation_to_text(turns),
+                next_index=next_index,
+                incomplete=incomplete,
+                intent_definitions=intent_definitions,
+                confirmation_required=confirmation_required,
+                all_examples=all_examples_str,
+                special_guidance=special_guidance,
+            )
+            prompt = Prompt(prefix=prefix, stop_texts=["user:", "\n"])
 
-        if SHOW_PROMPT:
-            rich.print(Panel(escape("\n".join(prefix.split("\n")))))
+            if SHOW_PROMPT:
+                rich.print(Panel(escape("\n".join(prefix.split("\n")))))
 
-        first_system_turn = num_system_turns == 0
+            for i in range(NUM_GENERATION_ATTEMPTS):
+                if SELF_CONSISTENCY_VALIDATION:
+                    samples = await completer_self_consistency_async(
+                        first_system_turn, prompt, completer, 1 + len(LLM_VALIDATION_NAMES)
+                    )
+                else:
+                    samples = [
+                        await completer_no_slot_values_async(
+                            first_system_turn, prompt, completer, conversation_rules
+                        )
+                    ]
+
+                # We check the command can be executed before paying for slot values and validation
+                # .. and if it can't, the next sample is tried as the prediction instead
+                sample_index, pre_validation_error = 0, "No usable prediction was sampled"
+                for sample_index, predicted_output_no_values in enumerate(samples):
+                    pre_validation_error = executor.pre_validate(
+                        ProgramTurn(index=next_index, expression=predicted_output_no_values.strip())
+                    )
+                    record(
+                        "pre_validation",
+                        passed=pre_validation_error is None,
+                        reason=pre_validation_error,
+                    )
+                    if pre_validation_error is None:
+                        break
+                    print("Pre-validation failed:", pre_validation_error)
+
+                if pre_validation_error is not None:
+                    if i == NUM_GENERATION_ATTEMPTS - 1:
+                        raise StageExecutionException(
+                            f"Invalid SSA failed pre-validation after {NUM_GENERATION_ATTEMPTS} attempts. On final attempt, failed with the following error: {pre_validation_error}"
+                        )
+                    continue
 
-        for i in range(NUM_GENERATION_ATTEMPTS):
-            predicted_output_no_values = completer_no_slot_values(
-                first_system_turn, prompt, completer, conversation_rules
-            )
+                # Rejected samples would always disagree, so only the later samples validate
+                # .. the prediction (any validations missing fall back to their own request)
+                validation_samples = None
+                if SELF_CONSISTENCY_VALIDATION:
+                    validation_samples = samples[sample_index + 1 :]
 
-            if '"' in predicted_output_no_values:
-                predicted_output = generate_slot_values(input_turns, predicted_output_no_values)
-            else:
-                predicted_output = predicted_output_no_values
-
-            error_file = perform_validation(
-                first_system_turn,
-                predicted_output_no_values,
-                predicted_output,
-                prompt,
-                completer,
-                input_turns,
-                intent_definitions,
-                conversation_rules,
-                tags_extracted,
-                turns[-1],
-            )
-            program_turn = ProgramTurn(
-                index=next_index, expression=predicted_output.strip(), errors=error_file
-            )
-            try:
-                last_value = executor.execute_turn(program_turn)
-                rich.print(
-                    Columns([str(program_turn.index), Syntax(program_turn.expression, "python")])
+                if '"' in predicted_output_no_values:
+                    predicted_output = await generate_slot_values_async(
+                        input_turns, predicted_output_no_values
+                    )
+                else:
+                    predicted_output = predicted_output_no_values
+
+                error_file = await perform_validation_async(
+                    first_system_turn,
+                    predicted_output_no_values,
+                    predicted_output,
+                    prompt,
+                    completer,
+                    input_turns,
+                    intent_definitions,
+                    conversation_rules,
+                    tags_extracted,
+                    turns[-1],
+                    next_index,
+                    validation_samples,
+                    trace_id,
+                )
+                program_turn = ProgramTurn(
+                    index=next_index, expression=predicted_output.strip(), errors=error_file
                 )
-                if last_value.recommended_action is not None:
+                # A failed attempt may have partly updated the state, so we undo it before retrying
+                snapshot = executor.snapshot()
+                try:
+                    last_value = executor.execute_turn(program_turn)
                     rich.print(
                         Columns(
-                            [
-                                str(next_index + 1),
-                                Syntax(str(last_value.recommended_action), "python"),
-                            ]
+                            [str(program_turn.index), Syntax(program_turn.expression, "python")]
                         )
                     )
-                break
-            except Exception as e:
-                if i == NUM_GENERATION_ATTEMPTS:
-                    raise StageExecutionException(
-                        f"Invalid SSA failed execution after {NUM_GENERATION_ATTEMPTS} attempts. On final attempt, failed with the following error: {e}"
-                    )
+                    if last_value.recommended_action is not None:
+                        rich.print(
+                            Columns(
+                                [
+                                    str(next_index + 1),
+                                    Syntax(str(last_value.recommended_action), "python"),
+                                ]
+                            )
+                        )
+                    break
+                except Exception as e:
+                    executor.restore(snapshot)
+                    if i == NUM_GENERATION_ATTEMPTS - 1:
+                        raise StageExecutionException(
+                            f"Invalid SSA failed execution after {NUM_GENERATION_ATTEMPTS} attempts. On final attempt, failed with the following error: {e}"
+                        )
 
         turns.append(program_turn)
         num_system_turns += 1
         if program_turn.expression.startswith("say"):
-            generate_response(
+            await generate_response_async(
                 turns=turns,
                 prompt_template=response_prompt_template,
                 completer=completer,
@@ -374,3 +498,72 @@ def generate_system_turn(
             print("Too many system turns, breaking")
             break
     return turns
+
+
+async def generate_system_turn_async(
+    input_turns: List[Turn],
+    ssa_examples: List[str],
+    executor: ProgramExecutor,
+    intent_definitions: List[str],
+    confirmation_required: bool,
+    conversation_rules: str,
+    tags_extracted: List[str],
+    special_guidance: str,
+    determined_expression: Optional[str] = None,
+    trace_id: Optional[str] = None,
+) -> List[Turn]:
+    # New turns are appended in place, and are rolled back (with the executor) if generation fails
+    turns = Transcript.of(input_turns)
+    checkpoint = turns.checkpoint()
+    executor_snapshot = executor.snapshot()
+
+    try:
+        with timed("system_turn") as metric_fields:
+            result = await _generate_system_turn_async(
+                turns,
+                # Slot values and validation only see the conversation before this system turn
+                turns[:checkpoint],
+                ssa_examples,
+                executor,
+                intent_definitions,
+                confirmation_required,
+                conversation_rules,
+                tags_extracted,
+                special_guidance,
+                determined_expression,
+                trace_id,
+            )
+            metric_fields["new_turns"] = len(turns) - checkpoint
+        return result
+    except Exception:
+        turns.rollback(checkpoint)
+        executor.restore(executor_snapshot)
+        raise
+
+
+def generate_system_turn(
+    input_turns: List[Turn],
+    ssa_examples: List[str],
+    executor: ProgramExecutor,
+    intent_definitions: List[str],
+    confirmation_required: bool,
+    conversation_rules: str,
+    tags_extracted: List[str],
+    special_guidance: str,
+    determined_expression: Optional[str] = None,
+    trace_id: Optional[str] = None,
+) -> List[Turn]:
+    return run_sync(
+        generate_system_turn_async(
+            input_turns,
+            ssa_examples,
+            executor,
+            intent_definitions,
+            confirmation_required,
+            conversation_rules,
+            tags_extracted,
+            special_guidance,
+            determined_expression,
+            trace_id,
+        )
+    )
@@ -3,8 +3,6 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
-import asyncio
-from copy import deepcopy
 from textwrap import dedent
 from typing import List
 
@@ -13,10 +11,12 @@ from jinja2 import Environment
 from rich.markup import escape
 from rich.panel import Panel
 
-from lucid_generate_data.modelling_constants import STAGE_MODEL_LOOKUP
-from lucid_generate_data.utils.completer import OpenAiChatCompleter, Prompt
+from lucid_generate_data.openai_call import get_stage_completer
+from lucid_generate_data.utils.completer import CompletionPool, Prompt
 from lucid_generate_data.stage import StageExecutionException
-from lucid_generate_data.utils.definitions import AppContext, LucidTurn, Turn, UserTurn
+from lucid_generate_data.utils.definitions import AppContext, LucidTurn, Transcript, Turn, UserTurn
+from lucid_generate_data.utils.event_loop import run_sync
+from lucid_generate_data.utils.metrics import timed
 
 environment = Environment()
 
@@ -77,7 +77,7 @@ def _format_examples(list_of_examples: List[str]):
     return full_str
 
 
-def generate_user_turn(
+async def generate_user_turn_async(
     input_turns: List[Turn],
     examples: List[str],
     intent_definitions: List[str],
@@ -87,14 +87,11 @@ def generate_user_turn(
 ):
     examples_str = _format_examples(examples)
 
-    turns = deepcopy(input_turns)
+    # The user turn is only appended once generated, so the transcript is not copied
+    turns = Transcript.of(input_turns)
     SHOW_PROMPT = True
 
-    completer = OpenAiChatCompleter(
-        model_name=STAGE_MODEL_LOOKUP["user_agent"]["model_name"],
-        max_tokens=STAGE_MODEL_LOOKUP["user_agent"]["max_tokens"],
-        temperature=STAGE_MODEL_LOOKUP["user_agent"]["temperature"],
-    )
+    completer = get_stage_completer("user_agent")
 
     prefix = prompt_template.render(
         example=examples_str,
@@ -109,20 +106,45 @@ def generate_user_turn(
     if SHOW_PROMPT:
         rich.print(Panel(escape("\n".join(prefix.split("\n")))))
 
+    # Every attempt is sampled in one request, and later attempts use the remaining candidates
+    candidates = CompletionPool(completer, NUM_GENERATION_ATTEMPTS, stage_name="user_turn")
+
     user_utterance = None
-    for i in range(NUM_GENERATION_ATTEMPTS):
-        # need to strip the user: prefix as this gets added back by demo.conversation_to_text
-        generated_text = asyncio.run(completer.complete(prompt, use_cache=False))
-        if generated_text.startswith("user:"):
-            generated_text = generated_text[len("user:") :].strip()
-        if is_valid_user_turn(generated_text):
-            # We remove quotes, to prevent the model putting quotes around string slot values
-            generated_text = generated_text.replace('"', "")
-            user_utterance = generated_text
-            break
-
-    if user_utterance is None:
-        raise StageExecutionException("Invalid user response (this was given as None)")
+    with timed("user_turn") as metric_fields:
+        for i in range(NUM_GENERATION_ATTEMPTS):
+            metric_fields["attempts"] = i + 1
+            # need to strip the user: prefix as this gets added back by demo.conversation_to_text
+            generated_text = await candidates.next(prompt)
+            if generated_text.startswith("user:"):
+                generated_text = generated_text[len("user:") :].strip()
+            if is_valid_user_turn(generated_text):
+                # We remove quotes, to prevent the model putting quotes around string slot values
+                generated_text = generated_text.replace('"', "")
+                user_utterance = generated_text
+                break
+
+        if user_utterance is None:
+            raise StageExecutionException("Invalid user response (this was given as None)")
 
     turns.append(UserTurn(query=user_utterance, tags=[]))
     return turns
+
+
+def generate_user_turn(
+    input_turns: List[Turn],
+    examples: List[str],
+    intent_definitions: List[str],
+    conversation_rules: str,
+    confirmation_required: bool,
+    app_context: AppContext,
+):
+    return run_sync(
+        generate_user_turn_async(
+            input_turns,
+            examples,
+            intent_definitions,
+            conversation_rules,
+            confirmation_required,
+            app_context,
+        )
+    )
@@ -65,3 +65,16 @@ STAGE_MODEL_LOOKUP = {
         "temperature": 0.7,
     },  # Stage 11 (generating conversations)
 }
+
+# Quotas for each model used above, shared by all requests made by the process.
+# .. These should be set to match your OpenAI account limits
+MODEL_RATE_LIMITS = {
+    "gpt-3.5-turbo": {
+        "requests_per_minute": 3500,
+        "tokens_per_minute": 90000,
+    },
+    "gpt-4": {
+        "requests_per_minute": 200,
+        "tokens_per_minute": 40000,
+    },
+}
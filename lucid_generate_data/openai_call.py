@@ -3,10 +3,12 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
-import asyncio
+import threading
+from typing import Dict, List, Optional, Tuple
 
 from lucid_generate_data.modelling_constants import STAGE_MODEL_LOOKUP
-from lucid_generate_data.utils.completer import OpenAiChatCompleter, Prompt
+from lucid_generate_data.utils.completer import CompletionPool, OpenAiChatCompleter, Prompt
+from lucid_generate_data.utils.event_loop import run_sync
 
 
 def _update_float_format(command: str):
@@ -185,29 +187,75 @@ def _resolve_differences(response_main: str, response_valid: str) -> str:
         )
 
 
-def completer_with_llm_validation(
+def resolve_sampled_validations(
+    response_main: str, validation_samples: List[str]
+) -> List[Tuple[bool, Optional[str]]]:
+    """
+    We compare validation predictions sampled with the main prediction against it
+    """
+    return [_resolve_differences(response_main, sample) for sample in validation_samples]
+
+
+async def completer_with_llm_validation_async(
     first_system_turn: bool,
     prompt: Prompt,
     completer: OpenAiChatCompleter,
     response_main: str,
     conversation_rules,
 ) -> str:
-    response_valid = asyncio.run(completer.complete(prompt, use_cache=False))
+    response_valid = await completer.complete(
+        prompt, use_cache=False, stage_name="system_turn_validation"
+    )
 
     assert response_valid is not None
 
     return _resolve_differences(response_main, _format_values(first_system_turn, response_valid))
 
 
-def completer_no_slot_values(
+def completer_with_llm_validation(
+    first_system_turn: bool,
+    prompt: Prompt,
+    completer: OpenAiChatCompleter,
+    response_main: str,
+    conversation_rules,
+) -> str:
+    return run_sync(
+        completer_with_llm_validation_async(
+            first_system_turn, prompt, completer, response_main, conversation_rules
+        )
+    )
+
+
+async def completer_no_slot_values_async(
     first_system_turn: bool, prompt: Prompt, completer: OpenAiChatCompleter, conversation_rules
 ) -> str:
-    response_main = asyncio.run(completer.complete(prompt, use_cache=False))
+    response_main = await completer.complete(prompt, use_cache=False, stage_name="system_turn")
 
     return _format_values(first_system_turn, response_main)
 
 
-def completer_with_llm_cheating(
+async def completer_self_consistency_async(
+    first_system_turn: bool, prompt: Prompt, completer: OpenAiChatCompleter, num_samples: int
+) -> List[str]:
+    """
+    We sample the main prediction and the validation predictions together, in one request
+    """
+    responses = await completer.complete_many(
+        prompt, num_samples, use_cache=False, stage_name="system_turn"
+    )
+
+    return [_format_values(first_system_turn, response) for response in responses]
+
+
+def completer_no_slot_values(
+    first_system_turn: bool, prompt: Prompt, completer: OpenAiChatCompleter, conversation_rules
+) -> str:
+    return run_sync(
+        completer_no_slot_values_async(first_system_turn, prompt, completer, conversation_rules)
+    )
+
+
+async def completer_with_llm_cheating_async(
     first_system_turn: bool,
     prompt: Prompt,
     completer: OpenAiChatCompleter,
@@ -221,7 +269,9 @@ def completer_with_llm_cheating(
         + "\nHowever, you should only make predictions about what the user has explicitly said. Do not include slot names or slot values unless the user has explicitly mentioned these. \n\nConversation:",
     )
 
-    response_cheating = asyncio.run(completer.complete(prompt, use_cache=False))
+    response_cheating = await completer.complete(
+        prompt, use_cache=False, stage_name="system_turn_cheating"
+    )
     assert response_cheating is not None
 
     if _format_values(first_system_turn, response_cheating) == response_main:
@@ -237,17 +287,79 @@ def completer_with_llm_cheating(
     return _format_values(first_system_turn, response_cheating)
 
 
-def make_openai_call(stage_name: str, prompt: str) -> str:
+def completer_with_llm_cheating(
+    first_system_turn: bool,
+    prompt: Prompt,
+    completer: OpenAiChatCompleter,
+    conversation_rules: str,
+    response_main: str,
+) -> str:
+    return run_sync(
+        completer_with_llm_cheating_async(
+            first_system_turn, prompt, completer, conversation_rules, response_main
+        )
+    )
+
+
+_completers: Dict[Tuple[str, int, float], OpenAiChatCompleter] = {}
+_completers_lock = threading.Lock()
+
+
+def get_stage_completer(stage_name: str) -> OpenAiChatCompleter:
+    """
+    We reuse one completer for every stage with the same model settings in STAGE_MODEL_LOOKUP
+    """
     assert stage_name in STAGE_MODEL_LOOKUP
 
     model_dict = STAGE_MODEL_LOOKUP[stage_name]
+    key = (model_dict["model_name"], model_dict["max_tokens"], model_dict["temperature"])
+
+    with _completers_lock:
+        if key not in _completers:
+            _completers[key] = OpenAiChatCompleter(
+                model_name=model_dict["model_name"],
+                max_tokens=model_dict["max_tokens"],
+                temperature=model_dict["temperature"],
+            )
+        return _completers[key]
 
-    completer = OpenAiChatCompleter(
-        model_name=model_dict["model_name"],
-        max_tokens=model_dict["max_tokens"],
-        temperature=model_dict["temperature"],
-    )
 
-    test_str = asyncio.run(completer.complete(Prompt(prefix=prompt), use_cache=False))
+def get_stage_pool(stage_name: str, n: int) -> CompletionPool:
+    """
+    We sample n candidates per request for retry loops, which draw from these before calling again
+    """
+    return CompletionPool(get_stage_completer(stage_name), n, stage_name=stage_name)
+
+
+async def make_openai_call_async(
+    stage_name: str, prompt: str, pool: Optional[CompletionPool] = None
+) -> str:
+    if pool is not None:
+        return await pool.next(Prompt(prefix=prompt))
+
+    completer = get_stage_completer(stage_name)
+
+    test_str = await completer.complete(
+        Prompt(prefix=prompt), use_cache=False, stage_name=stage_name
+    )
 
     return test_str
+
+
+def make_openai_call(stage_name: str, prompt: str, pool: Optional[CompletionPool] = None) -> str:
+    return run_sync(make_openai_call_async(stage_name, prompt, pool))
+
+
+async def make_openai_calls_async(stage_name: str, prompt: str, n: int) -> List[str]:
+    """
+    We sample n completions of the prompt in one request
+    """
+    completer = get_stage_completer(stage_name)
+
+    return await completer.complete_many(
+        Prompt(prefix=prompt), n, use_cache=False, stage_name=stage_name
+    )
+
+
+def make_openai_calls(stage_name: str, prompt: str, n: int) -> List[str]:
+    return run_sync(make_openai_calls_async(stage_name, prompt, n))
@@ -4,13 +4,17 @@
 #
 
 import json
-import logging
 import os
-from os import listdir
-from os.path import isfile, join
-
-from lucid_generate_data.run_scripts.constants import INTENT_PATH
-from lucid_generate_data.execute import execute, load_config
+import time
+from pathlib import Path
+
+from lucid_generate_data.scheduler import ConcurrentTraceRunner, TraceJob
+from lucid_generate_data.utils.cache import get_cache_stats
+from lucid_generate_data.utils.checkpoint import CheckpointStore
+from lucid_generate_data.utils.completer import close_http_session
+from lucid_generate_data.utils.event_loop import run_sync
+from lucid_generate_data.utils.intent_catalog import get_intent_catalog
+from lucid_generate_data.utils.metrics import configure_metrics, format_summary
 from lucid_generate_data.utils.definitions import (
     ProgramTurn,
     UserTurn,
@@ -22,6 +26,16 @@ from lucid_generate_data.utils.definitions import (
 CONVS_PER_INTENT = 1
 MAX_INTENTS_IN_CONVERSATION = 1
 UNHAPPY_PATHS = ["start_multi_slot"]
+MAX_CONCURRENT_CONVERSATIONS = 8
+# Seeds the random choices made when planning each conversation. Set a RUN_SEED to make a run
+# .. resumable and replayable (see utils/replay.py): rerunning with the same seed resumes it (or
+# .. replays it), so use a new seed for each new batch of conversations. None is an unseeded run
+RUN_SEED = None
+# Each conversation's progress is checkpointed here (for seeded runs), so a restarted run
+# .. only redoes the stages that had not finished
+CHECKPOINT_DIR = "lucid_generate_data/checkpoints"
+# Timings, token usage, retries and validation results are logged here (as JSONL)
+METRICS_DIR = "lucid_generate_data/metrics"
 
 
 def save_conversation(filename: str, conv: dict):
@@ -60,22 +74,13 @@ def get_list_of_turns(trace):
 
 if __name__ == "__main__":
     config_path = "lucid_generate_data/configs/run_with_created_intents.yaml"
-    stages = load_config(config_path)
-
-    num_conversations = 0
-
-    all_intents = []
-
-    mypath = INTENT_PATH + "/"
 
-    file_list = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-    for file in file_list:
-        if file[-5:] == ".json":
-            with open(mypath + file, "r") as json_file:
-                intent = json.load(json_file)
-            all_intents.append(intent)
+    # The intents are loaded once, and shared with the planner
+    intent_catalog = get_intent_catalog()
 
-    for intent in all_intents:
+    jobs = []
+    for command in intent_catalog.commands:
+        intent = intent_catalog.get(command)
         assert intent["confirmation_required"]
 
         for _ in range(0, CONVS_PER_INTENT):
@@ -84,16 +89,41 @@ if __name__ == "__main__":
                 "rules_to_be_applied": UNHAPPY_PATHS,
                 "primary_intent_json": intent,
             }
-            try:
-                execute(stages, trace)
-                output_dict = {"turns": get_list_of_turns(trace)}
-                output_dict["dialogue_id"] = str(num_conversations)
-                output_dict["unhappy_path"] = "None"
-
-                save_conversation("conversation_" + str(num_conversations), output_dict)
-                print("Saved conversation:", num_conversations)
-
-                num_conversations += 1
-
-            except Exception as e:
-                logging.error(e)
+            if RUN_SEED is not None:
+                trace["seed"] = f"{RUN_SEED}-{len(jobs)}"
+            jobs.append(TraceJob(job_id=str(len(jobs)), trace=trace))
+
+    def save_finished_conversation(job: TraceJob) -> None:
+        # Conversations are saved as soon as they finish, numbered by job
+        # .. so that a resumed run does not overwrite conversations already saved
+        output_dict = {"turns": get_list_of_turns(job.trace)}
+        output_dict["dialogue_id"] = job.job_id
+        output_dict["unhappy_path"] = "None"
+
+        save_conversation("conversation_" + job.job_id, output_dict)
+        print("Saved conversation:", job.job_id)
+
+    # Unseeded runs are logged separately, as they are never resumed
+    run_name = f"run_{RUN_SEED}" if RUN_SEED is not None else f"run_unseeded_{int(time.time())}"
+    metrics = configure_metrics(Path(METRICS_DIR) / f"{run_name}.jsonl")
+
+    checkpoint_store = None
+    if RUN_SEED is not None:
+        checkpoint_store = CheckpointStore(Path(CHECKPOINT_DIR) / run_name)
+
+    runner = ConcurrentTraceRunner(
+        config_path,
+        max_concurrency=MAX_CONCURRENT_CONVERSATIONS,
+        checkpoint_store=checkpoint_store,
+    )
+    runner.run(jobs, save_finished_conversation)
+    run_sync(close_http_session())
+
+    for cache_dir, stats in get_cache_stats().items():
+        print(
+            f"Cache {cache_dir}: {stats.hits} hits ({stats.memory_hits} from memory), {stats.misses} misses, "
+            f"{stats.disk_evictions} evictions, {stats.disk_bytes / 1e6:.1f}MB on disk"
+        )
+
+    print(format_summary(metrics.summary()))
+    metrics.close()
@@ -0,0 +1,84 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from lucid_generate_data.execute import execute_async, load_config
+from lucid_generate_data.utils.checkpoint import CheckpointStore
+from lucid_generate_data.utils.event_loop import run_sync
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+@dataclass
+class TraceJob:
+    job_id: str
+    trace: Dict[str, Any]
+
+
+class ConcurrentTraceRunner:
+    """Runs many pipeline traces at once, on the shared event loop.
+
+    Generation is bound by LLM latency rather than CPU, so running several
+    traces side by side gives close to linear speed-ups (up to the rate limit).
+
+    With a checkpoint store, each trace is checkpointed by job id. A restarted run skips
+    jobs whose results were already handled, and resumes the others from their last stage.
+    """
+
+    def __init__(
+        self,
+        config_path: str,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        checkpoint_store: Optional[CheckpointStore] = None,
+    ):
+        self.config_path = config_path
+        self.max_concurrency = max_concurrency
+        self.checkpoint_store = checkpoint_store
+
+    async def run_async(
+        self, jobs: Iterable[TraceJob], on_result: Callable[[TraceJob], None]
+    ) -> int:
+        """
+        Execute all jobs, calling on_result as each one finishes
+        """
+        # Each worker has its own stage objects, so no state is shared between traces
+        workers: asyncio.Queue = asyncio.Queue()
+        for _ in range(self.max_concurrency):
+            workers.put_nowait(load_config(self.config_path))
+
+        async def run_job(job: TraceJob) -> Tuple[TraceJob, Optional[Exception]]:
+            stages = await workers.get()
+            try:
+                await execute_async(stages, job.trace, self.checkpoint_store, job.job_id)
+                return job, None
+            except Exception as e:
+                return job, e
+            finally:
+                workers.put_nowait(stages)
+
+        num_completed = 0
+
+        if self.checkpoint_store is not None:
+            jobs = [job for job in jobs if not self.checkpoint_store.is_finished(job.job_id)]
+
+        for next_finished in asyncio.as_completed([run_job(job) for job in jobs]):
+            job, error = await next_finished
+            if error is not None:
+                logging.error(f"Job {job.job_id} failed: {error}")
+                continue
+
+            on_result(job)
+            if self.checkpoint_store is not None:
+                self.checkpoint_store.mark_finished(job.job_id)
+            num_completed += 1
+
+        return num_completed
+
+    def run(self, jobs: Iterable[TraceJob], on_result: Callable[[TraceJob], None]) -> int:
+        return run_sync(self.run_async(jobs, on_result))
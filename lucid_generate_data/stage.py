@@ -3,11 +3,16 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Type
+from typing import Any, Dict, Tuple, Type
 
 
 class Stage(ABC):
+    # Trace keys returned by the stage. These are used to check a pipeline's inputs before
+    # .. it runs, and stages that leave this empty are not checked
+    outputs: Tuple[str, ...] = ()
+
     def __init_subclass__(cls, **kwargs: Any) -> None:
         super().__init_subclass__(**kwargs)
         register_class(cls)
@@ -16,6 +21,14 @@ class Stage(ABC):
     def __call__(self, **kwargs: Any) -> Dict[str, Any]:
         raise NotImplementedError
 
+    async def call_async(self, **kwargs: Any) -> Dict[str, Any]:
+        """Async variant of __call__.
+
+        Stages without an async-native implementation are run in a worker thread,
+        so they do not block other stages waiting on the event loop.
+        """
+        return await asyncio.to_thread(self.__call__, **kwargs)
+
 
 _registry: Dict[str, Type[Stage]] = {}
 
@@ -13,6 +13,8 @@ from lucid_generate_data.stage import Stage, StageExecutionException
 
 
 class GenerateAppIntent(Stage):
+    outputs = ("intent_no_values", "intent_name")
+
     def __init__(self) -> None:
         self.prompt = """
 The task is to generate mobile app intent definitions in JSON format. The following rules must be followed strictly:
@@ -5,10 +5,16 @@
 
 from typing import Any, Dict, List, Type, Optional, Tuple, Union
 
-from lucid_generate_data.validate_with_tags import LIST_OF_TAGS_POSSIBLE
-from lucid_generate_data.generate_system_turn import generate_system_turn
-from lucid_generate_data.generate_user_turn import generate_user_turn
+from lucid_generate_data.validate_with_tags import LIST_OF_TAGS_POSSIBLE, command_from_tags
+from lucid_generate_data.generate_system_turn import generate_system_turn_async
+from lucid_generate_data.generate_user_turn import generate_user_turn_async
 from lucid_generate_data.stage import StageExecutionException, Stage
+from lucid_generate_data.truncation_rules import (
+    can_keep_without_checkpoint,
+    has_empty_str,
+    is_checkpoint,
+    predicts_hint,
+)
 
 from lucid_generate_data.output_conversation_rules import output_conversation_rules_current_intent
 from lucid_generate_data.utils.definitions import (
@@ -19,9 +25,12 @@ from lucid_generate_data.utils.definitions import (
     LucidTurn,
     AutoTurn,
     AutoTransientTurn,
+    Transcript,
 )
 from lucid_generate_data.executor.executor import ExecutionState, ProgramExecutor
 from lucid_generate_data.utils.commands import Command, CommandRegistry, Hint, Perform, Say
+from lucid_generate_data.utils.event_loop import run_sync
+from lucid_generate_data.utils.metrics import record
 from lucid_generate_data.code_gen import (
     AppIntent,
     create_entity_from_intent,
@@ -33,6 +42,13 @@ from lucid_generate_data.code_gen import (
 )
 
 PRINT_TURNS = False
+# compile_data discards every turn after a system turn with errors (past the last checkpoint), so
+# .. once one appears (with STOP_ON_ERROR off) we either keep generating ("off"), end the
+# .. conversation ("stop"), or regenerate from the last checkpoint ("rollback")
+TRUNCATION_POLICY = "rollback"
+TRUNCATION_POLICIES = ("off", "stop", "rollback")
+# After this many rollbacks in a conversation, we stop instead
+MAX_ROLLBACKS = 2
 
 
 def build_custom_registry(custom_classes: list[Type[Command]]) -> CommandRegistry:
@@ -42,6 +58,8 @@ def build_custom_registry(custom_classes: list[Type[Command]]) -> CommandRegistr
 
 
 class SSAConversation(Stage):
+    outputs = ("turns_with_hints",)
+
     def __init__(self):
         self.max_trial = 5
         self.max_conversation_len = 50
@@ -192,6 +210,98 @@ class SSAConversation(Stage):
 
         return special_guidance
 
+    def is_checkpoint(self, turn: Turn) -> bool:
+        """
+        Matches compile_data.search_for_checkpoint: turns are kept up to the next user turn
+        """
+        if isinstance(turn, ProgramTurn):
+            return is_checkpoint("System", turn.expression)
+        if isinstance(turn, AutoTurn):
+            return is_checkpoint("AutoTurn", turn.expression)
+        return False
+
+    def has_errors(self, turn: Turn) -> bool:
+        """
+        Matches the system turn errors found by compile_data (validation and post-processing)
+        """
+        if not isinstance(turn, ProgramTurn):
+            return False
+        return (
+            turn.errors is not None
+            or predicts_hint(turn.expression)
+            or has_empty_str(turn.expression)
+        )
+
+    def last_user_turn_index(self, turns: List[Turn]) -> int:
+        """
+        The index of the last user turn, in the turns as saved for compile_data (one for one)
+        """
+        return max(i for i, turn in enumerate(turns) if isinstance(turn, UserTurn))
+
+    def turns_kept(
+        self, turns: List[Turn], checkpoint_reached: bool, last_checkpoint: Dict[str, Any]
+    ) -> int:
+        """
+        How many turns compile_data keeps, when the turns end with a system turn with errors
+        """
+        if checkpoint_reached:
+            return last_checkpoint["transcript"]
+
+        last_user_turn_index = self.last_user_turn_index(turns)
+        if can_keep_without_checkpoint(last_user_turn_index):
+            return last_user_turn_index + 1
+        return 0
+
+    def save_position(
+        self,
+        turns: Transcript,
+        executor: ProgramExecutor,
+        num_turns: int,
+        intent_number: int,
+        tags_already_seen_for_intent: List[str],
+        tags: List[str],
+        conversation_rules: str,
+    ) -> Dict[str, Any]:
+        """
+        We save where we are in the conversation (before the next system turn), to roll back to
+        """
+        return {
+            "transcript": turns.checkpoint(),
+            "executor": executor.snapshot(),
+            "num_turns": num_turns,
+            "intent_number": intent_number,
+            "tags_already_seen_for_intent": list(tags_already_seen_for_intent),
+            "tags": list(tags),
+            "conversation_rules": conversation_rules,
+        }
+
+    def restore_position(
+        self, turns: Transcript, executor: ProgramExecutor, position: Dict[str, Any]
+    ) -> Tuple[int, int, List[str], List[str], str]:
+        turns.rollback(position["transcript"])
+        executor.restore(position["executor"])
+
+        return (
+            position["num_turns"],
+            position["intent_number"],
+            list(position["tags_already_seen_for_intent"]),
+            list(position["tags"]),
+            position["conversation_rules"],
+        )
+
+    def should_roll_back(
+        self, checkpoint_reached: bool, last_user_turn_index: int, num_rollbacks: int
+    ) -> bool:
+        if TRUNCATION_POLICY != "rollback" or num_rollbacks >= MAX_ROLLBACKS:
+            return False
+
+        # Without a checkpoint, we would be rolling back to the start of the conversation,
+        # .. so we keep what compile_data can still retrieve instead
+        if not checkpoint_reached and can_keep_without_checkpoint(last_user_turn_index):
+            return False
+
+        return True
+
     def update_position_in_converesation(
         self,
         turns: List[Union[ProgramTurn, LucidTurn, UserTurn, AutoTurn, AutoTransientTurn]],
@@ -238,7 +348,7 @@ class SSAConversation(Stage):
 
         return intent_number, tags_already_seen_for_intent, tags
 
-    def __call__(  # type: ignore
+    async def call_async(  # type: ignore
         self,
         intents: List[Dict[str, Any]],
         full_intent_list: List[str],
@@ -248,6 +358,7 @@ class SSAConversation(Stage):
         unhappy_path_args: List[List[str]],
         query_info: Dict[str, Dict[str, Any]],
         query_entity: Optional[str] = None,
+        trace_id: Optional[str] = None,
     ) -> List[Turn]:
         intent_number = 0
         tags_already_seen_for_intent = []
@@ -265,14 +376,34 @@ class SSAConversation(Stage):
         )
 
         executor, all_intent_definitions, app_context = self.create_executor(intents, query_info)
-        turns: List[Turn] = [
-            UserTurn(query="hey lucid", tags=[[]]),
-        ]
+        turns: List[Turn] = Transcript(
+            [
+                UserTurn(query="hey lucid", tags=[[]]),
+            ]
+        )
+
+        if TRUNCATION_POLICY not in TRUNCATION_POLICIES:
+            raise ValueError(
+                f"Unknown truncation policy {TRUNCATION_POLICY}, expected one of {TRUNCATION_POLICIES}"
+            )
 
         try:
             num_turns = 1
             confirmation_required = intents[0]["confirmation_required"]
 
+            # We can roll back to the start of the conversation, or the user turn after a checkpoint
+            last_checkpoint = self.save_position(
+                turns,
+                executor,
+                num_turns,
+                intent_number,
+                tags_already_seen_for_intent,
+                tags,
+                conversation_rules,
+            )
+            checkpoint_reached = False
+            num_rollbacks = 0
+
             # We generate system and user turns until the user ends the conversation
             # .. or we have reached the maximum number of turns
             while (
@@ -282,7 +413,11 @@ class SSAConversation(Stage):
                 # Some unhappy paths require extra guidance in the LLM prompt
                 special_guidance = self.special_guidance_from_tags(tags)
 
-                turns = generate_system_turn(
+                # Others fully determine the system command, which then needs no LLM calls
+                determined_expression = command_from_tags(tags)
+
+                system_turns_start = turns.checkpoint()
+                turns = await generate_system_turn_async(
                     input_turns=turns,
                     ssa_examples=ssa_examples[intent_number],
                     executor=executor,
@@ -291,7 +426,42 @@ class SSAConversation(Stage):
                     conversation_rules=conversation_rules,
                     tags_extracted=tags,
                     special_guidance=special_guidance,
+                    determined_expression=determined_expression,
+                    trace_id=trace_id,
                 )
+                new_system_turns = turns[system_turns_start:]
+
+                # The rest of the conversation would be discarded, so we don't generate it
+                if TRUNCATION_POLICY != "off" and any(
+                    self.has_errors(turn) for turn in new_system_turns
+                ):
+                    if self.should_roll_back(
+                        checkpoint_reached,
+                        self.last_user_turn_index(turns[:system_turns_start]),
+                        num_rollbacks,
+                    ):
+                        record(
+                            "truncation",
+                            action="rollback",
+                            turns_discarded=len(turns) - last_checkpoint["transcript"],
+                        )
+                        print("Error in system turn, rolling back to the last checkpoint")
+                        num_rollbacks += 1
+                        (
+                            num_turns,
+                            intent_number,
+                            tags_already_seen_for_intent,
+                            tags,
+                            conversation_rules,
+                        ) = self.restore_position(turns, executor, last_checkpoint)
+                        continue
+
+                    turns_kept = self.turns_kept(turns, checkpoint_reached, last_checkpoint)
+                    record("truncation", action="stop", turns_discarded=len(turns) - turns_kept)
+                    print("Error in system turn, ending the conversation")
+                    break
+
+                new_checkpoint = any(self.is_checkpoint(turn) for turn in new_system_turns)
 
                 # We see what intents and unhappy paths are already completed
                 (
@@ -322,7 +492,7 @@ class SSAConversation(Stage):
                     shown_examples = examples[intent_number]
 
                 # Generate the user turn
-                turns = generate_user_turn(
+                turns = await generate_user_turn_async(
                     input_turns=turns,
                     examples=shown_examples,
                     intent_definitions=all_intent_definitions,
@@ -344,9 +514,48 @@ class SSAConversation(Stage):
                 # We limit how many turns per conversation (stops infinite user/system loops)
                 num_turns += 1
 
+                # The conversation is kept up to this user turn, whatever comes next
+                if new_checkpoint:
+                    checkpoint_reached = True
+                    last_checkpoint = self.save_position(
+                        turns,
+                        executor,
+                        num_turns,
+                        intent_number,
+                        tags_already_seen_for_intent,
+                        tags,
+                        conversation_rules,
+                    )
+
         except Exception as e:
             raise StageExecutionException(
                 f"Invalid SSA failed execution (generate_conservation.py main call): {e}"
             )
 
         return {"turns_with_hints": turns}
+
+    def __call__(  # type: ignore
+        self,
+        intents: List[Dict[str, Any]],
+        full_intent_list: List[str],
+        examples: List[str],
+        ssa_examples: List[str],
+        rules_to_be_applied_by_intent: List[List[str]],
+        unhappy_path_args: List[List[str]],
+        query_info: Dict[str, Dict[str, Any]],
+        query_entity: Optional[str] = None,
+        trace_id: Optional[str] = None,
+    ) -> List[Turn]:
+        return run_sync(
+            self.call_async(
+                intents=intents,
+                full_intent_list=full_intent_list,
+                examples=examples,
+                ssa_examples=ssa_examples,
+                rules_to_be_applied_by_intent=rules_to_be_applied_by_intent,
+                unhappy_path_args=unhappy_path_args,
+                query_info=query_info,
+                query_entity=query_entity,
+                trace_id=trace_id,
+            )
+        )
@@ -3,9 +3,8 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
-import random
 from random import Random
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 import copy
 
 from jinja2 import Environment
@@ -28,6 +27,14 @@ NO_RETRIES = 5
 
 
 class GenerateConversationRules(Stage):
+    outputs = (
+        "rules_to_be_applied_by_intent",
+        "unhappy_path_args",
+        "examples",
+        "ssa_examples",
+        "query_info",
+    )
+
     def __init__(self) -> None:
         self.rules: List[ConversationRule] = conversation_rules
         self.rng = Random()
@@ -303,7 +310,7 @@ class GenerateConversationRules(Stage):
 
         prob_another = unhappy_rules_per_intent - rules
         if prob_another > 0:
-            if random.random() < prob_another:
+            if self.rng.random() < prob_another:
                 rules += 1
 
         return rules
@@ -518,10 +525,13 @@ class GenerateConversationRules(Stage):
         full_intent_list: List[str],  # List of intents with all slot values
         used_intent_args: List[List[str]],  # Slots used for each intent,
         rules_to_be_applied: List[str],
+        seed: Optional[str] = None,
     ) -> Dict[str, str]:  # type: ignore
         """
         We generate rules that the conversation should follow, including the desired final command
         """
+        self.rng.seed(None if seed is None else f"{seed}:{self.__class__.__name__}")
+
         # We allocate unhappy path rules to intents
         unhappy_paths_per_intent = self.allocate_number_rules_to_intents(
             len(rules_to_be_applied), len(intents)
@@ -7,7 +7,7 @@ from lucid_generate_data.stage import Stage
 from typing import Any, Dict, List, Optional, Tuple
 from random import Random
 from jinja2 import Environment
-from lucid_generate_data.openai_call import make_openai_call
+from lucid_generate_data.openai_call import get_stage_pool, make_openai_call
 from lucid_generate_data.utils.commands import (
     parse_system_function_call,
     check_parsed_slots_vs_intent_json,
@@ -16,9 +16,13 @@ from lucid_generate_data.utils.commands import (
 from lucid_generate_data.code_gen import intent_to_func_def
 
 NO_RETRIES = 6
+# Realistic commands sampled per request, which retries draw from before making another request
+REALISTIC_COMMAND_CANDIDATES = 3
 
 
 class GenerateFullIntents(Stage):
+    outputs = ("full_intent_list", "used_intent_args")
+
     def __init__(self) -> None:
         self.rng = Random()
         self.prob_optional_arg = 0.2
@@ -286,7 +290,7 @@ class GenerateFullIntents(Stage):
         return next_intent, used_slots
 
     def make_slot_values_more_realistic(
-        self, syntax, command, args, is_query, command_context=None
+        self, syntax, command, args, is_query, command_context=None, pool=None
     ):
         if is_query:
             prompt = """
@@ -373,7 +377,7 @@ class GenerateFullIntents(Stage):
         jinga_template = Environment().from_string(prompt)
         full_prompt = jinga_template.render(extra_info=extra_info, command=command, syntax=syntax)
         new_command = make_openai_call(
-            "make_slot_values_more_realistic", prompt=full_prompt
+            "make_slot_values_more_realistic", prompt=full_prompt, pool=pool
         ).strip()
 
         return new_command
@@ -500,15 +504,28 @@ class GenerateFullIntents(Stage):
             syntax = intent_to_func_def(intent)
             all_intents_def.append(syntax)
 
+            pool = get_stage_pool("make_slot_values_more_realistic", REALISTIC_COMMAND_CANDIDATES)
+            attempts_with_slot_values = REALISTIC_COMMAND_CANDIDATES
+
             while no_retries <= NO_RETRIES:
                 # We initially predict slot values based all the intents up to that point
-                command_raw, args, command_context = self.find_slot_vals_using_prev_intents(
-                    full_intent_list, intent
-                )
+                # .. and only predict them again (with a new context) once the realistic commands
+                # .. sampled for them have all failed
+                if attempts_with_slot_values == REALISTIC_COMMAND_CANDIDATES:
+                    command_raw, args, command_context = self.find_slot_vals_using_prev_intents(
+                        full_intent_list, intent
+                    )
+                    attempts_with_slot_values = 0
+                attempts_with_slot_values += 1
 
                 # We then try to make the slot values for that specific intent more realistic
                 command = self.make_slot_values_more_realistic(
-                    syntax, command_raw, args, command_raw.startswith("find_"), command_context
+                    syntax,
+                    command_raw,
+                    args,
+                    command_raw.startswith("find_"),
+                    command_context,
+                    pool=pool,
                 )
 
                 # We validate the data types of the proposed slot values
@@ -532,11 +549,12 @@ class GenerateFullIntents(Stage):
         syntax = intent_to_func_def(intents[0])
 
         no_retries = 0
+        pool = get_stage_pool("make_slot_values_more_realistic", REALISTIC_COMMAND_CANDIDATES)
 
         # We ask an LLM to update these slot values, making them more realistic
         while no_retries <= NO_RETRIES:
             command = self.make_slot_values_more_realistic(
-                syntax, command_raw, args, command_raw.startswith("find_")
+                syntax, command_raw, args, command_raw.startswith("find_"), pool=pool
             )
 
             # We validate the data types of the proposed slot values
@@ -555,10 +573,12 @@ class GenerateFullIntents(Stage):
     def __call__(
         self,
         intents: List[Dict[str, Any]],  # List of remaining intents
+        seed: Optional[str] = None,
     ) -> Dict[str, str]:  # type: ignore
         """
         We generate rules that the conversation should follow, including the desired final command
         """
+        self.rng.seed(None if seed is None else f"{seed}:{self.__class__.__name__}")
 
         # We generate the slots and slot values used for the first intent
         full_intent_list, used_intent_args, all_intents_def = self.get_intent_value_first_intent(
@@ -12,6 +12,8 @@ from lucid_generate_data.stage import Stage
 
 
 class GenerateAppIntentDescription(Stage):
+    outputs = ("intent_description",)
+
     def __init__(self) -> None:
         self.prompt = """
 The task is to produce a single sentence to describe an intent that a virtual AI assistant may execute from a phone.
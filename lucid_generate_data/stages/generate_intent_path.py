@@ -3,40 +3,27 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
-import json
-import random
-from typing import Any, Dict, List, Union
-from os import listdir
-from os.path import isfile, join
-import copy
+from random import Random
+from typing import Any, Dict, List, Optional, Union
 
 from jinja2 import Environment
 
-from lucid_generate_data.run_scripts.constants import INTENT_PATH
-from lucid_generate_data.openai_call import make_openai_call
+from lucid_generate_data.openai_call import get_stage_pool, make_openai_call
 from lucid_generate_data.stage import Stage, StageExecutionException
+from lucid_generate_data.utils.intent_catalog import get_intent_catalog
 
 INCLUDE_ALL_INTENTS_IN_SAME_DOMAIN = True
 PROB_FIRST_INTENT_QUERY = 0.25
 INTENTS_TO_INCLUDE = 10
-QUERY_DATE_OF_EXP = [
-    "yesterday",
-    "most recent",
-    "last time",
-    "last week",
-    "last one",
-    "the one before last",
-    "last one",
-    "last month",
-    "Monday",
-    "Tuesday",
-    "the weekend",
-    "last weekend",
-]
+# Intent paths sampled per request (most are usable, so we only sample a spare)
+INTENT_PATH_CANDIDATES = 2
 
 
 class GenerateRequestPath(Stage):
+    outputs = ("intents", "intent_path_reasoning")
+
     def __init__(self) -> None:
+        self.rng = Random()
         self.prompt = """
 
 Your task is to generate an abstract representation of a coherent conversation between a human and a virtual assistant, in the form of a series of function calls representing different intents.  You will be shown the allowed function calls in advance and you must decide which to include and how to order them. After generating the sequence of function calls, you must justify why this is a sensible sequence of intents.
@@ -174,31 +161,20 @@ Output 1)
 
     def get_all_intents(self) -> List[Dict[str, Any]]:
         """
-        Return a list of all intent JSONs
+        Return a list of all intent JSONs (shared with the intent catalog, so not to be modified)
         """
-        all_intents = []
-        mypath = INTENT_PATH + "/"
-
-        file_list = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-        for file in file_list:
-            if file[-5:] == ".json":
-                with open(mypath + file, "r") as json_file:
-                    intent = json.load(json_file)
-                all_intents.append(intent)
-
-        return all_intents
+        return get_intent_catalog().intents
 
     def get_sample_of_intents(
         self, all_intents: List[Dict[str, Any]], primary_intent: str, primary_domain: str
     ) -> (List[str], List[str]):
         # Sample a subset of these intents
         no_intents = min(INTENTS_TO_INCLUDE, len(list(all_intents)))
-        sample_of_intents = random.sample(all_intents, no_intents)
+        sample_of_intents = self.rng.sample(all_intents, no_intents)
 
         # We can also include all intents from the primary domain
         if INCLUDE_ALL_INTENTS_IN_SAME_DOMAIN:
-            domain_intents = [x for x in all_intents if (x["domain"] == primary_domain)]
-            sample_of_intents += domain_intents
+            sample_of_intents += get_intent_catalog().by_domain(primary_domain)
 
         # For each intent, we also also include its corresponding query intent
         intent_to_query_lookup = {}
@@ -213,66 +189,23 @@ Output 1)
         # We make sure the primary intent is included
         sample_intent_names = [primary_intent] + sample_intent_names
 
-        # Unique list of intents including primary intent
-        sample_intent_names = list(set(sample_intent_names))
+        # Unique list of intents including primary intent (keeping the order, so prompts are reproducible)
+        sample_intent_names = list(dict.fromkeys(sample_intent_names))
 
         return sample_intent_names, intent_to_query_lookup
 
-    def get_query_version(self, app_intent):
-        query_intent = copy.deepcopy(app_intent)
-        query_intent["query_intent"] = True
-        query_name = "find_" + query_intent["entity_name"]
-        query_intent["command"] = query_name
-
-        # There are some differences between the query intent and the corresponding transactional intent
-        for slot_name, slot_dict in app_intent["args"].items():
-            # We avoid slots that will clash with date_of_entity
-            if "date" in slot_name or "time" in slot_name or "day" in slot_name:
-                del query_intent["args"][slot_name]
-            else:
-                query_intent["args"][slot_name]["optional"] = True
-
-        # We introduce a new slot called date_of_[entity_name], that has a standard set of initial values
-        entity_name = query_intent["entity_name"]
-        query_intent["args"].update(
-            {
-                f"date_of_{entity_name}": {
-                    "type": "str",
-                    "values": QUERY_DATE_OF_EXP,
-                    "optional": False,
-                }
-            }
-        )
-
-        # Query intents do not require confirmation
-        query_intent["confirmation_required"] = False
-        query_intent["description"] = f"Query intent for finding existing {entity_name}"
-
-        return query_intent
-
     def update_query_intents(self, command_list, corresponding_intent, is_query_list):
         intents_json = []
+        catalog = get_intent_catalog()
 
         # Intent JSONs for query intents are derived from their corresponding transactional intent
         for i, intent in enumerate(command_list):
-            # We find the file path of the intent JSON
-            intent_path = INTENT_PATH
-
             if is_query_list[i]:
-                path = intent_path + "/" + corresponding_intent[i] + ".json"
-            else:
-                path = intent_path + "/" + intent + ".json"
-
-            with open(path, "r") as json_file:
-                intent_json = json.load(json_file)
-
-            # We update the query intent
-            if is_query_list[i]:
-                query_version = self.get_query_version(intent_json)
-                intents_json.append(query_version)
+                intents_json.append(catalog.get_query_version(corresponding_intent[i]))
 
             # For other intents, we use the JSON intent
             else:
+                intent_json = catalog.get(intent)
                 intent_json["query_intent"] = False
                 intents_json.append(intent_json)
 
@@ -294,9 +227,11 @@ Output 1)
             sample_of_intents=sample_of_intents,
         )
 
+        # Retries draw from the candidates already sampled, before making another request
+        pool = get_stage_pool("find_intent_path", INTENT_PATH_CANDIDATES)
         path_in_str = ""
         while "Output 2)" not in path_in_str:
-            path_in_str = make_openai_call("find_intent_path", prompt=full_prompt)
+            path_in_str = make_openai_call("find_intent_path", prompt=full_prompt, pool=pool)
 
             # Extract our intent path from this conversation
         (command_list, is_query_list, corresponding_intent, reasoning) = self.extract_command_list(
@@ -306,11 +241,15 @@ Output 1)
         return command_list, is_query_list, corresponding_intent, reasoning
 
     def __call__(
-        self, max_intents: int, primary_intent_json: Dict[str, Any]
+        self, max_intents: int, primary_intent_json: Dict[str, Any], seed: Optional[str] = None
     ) -> Dict[str, List[Union[str, bool]]]:
+        # A seed makes the sampled intent path reproducible (e.g. for replaying a run)
+        self.rng.seed(None if seed is None else f"{seed}:{self.__class__.__name__}")
+
         # We decide if the first intent is a query or not
-        if random.random() < PROB_FIRST_INTENT_QUERY:
-            primary_intent_json = self.get_query_version(primary_intent_json)
+        if self.rng.random() < PROB_FIRST_INTENT_QUERY:
+            primary_command = primary_intent_json["command"]
+            primary_intent_json = get_intent_catalog().get_query_version(primary_command)
 
         primary_intent = primary_intent_json["command"]
         primary_domain = primary_intent_json["domain"]
@@ -8,13 +8,15 @@ from typing import Any, Dict
 
 from jinja2 import Environment
 
-from lucid_generate_data.openai_call import make_openai_call
+from lucid_generate_data.openai_call import make_openai_calls
 from lucid_generate_data.stage import Stage
 
 REPEATED_CALLS = 15
 
 
 class GenerateAppIntentValues(Stage):
+    outputs = ("intent",)
+
     def __init__(self) -> None:
         self.prompt = """
 The task is to generate an additional field in mobile intent definitions in JSON format.
@@ -133,8 +135,10 @@ Generate an intent JSON for the intent:
 
         intent_with_values = None
 
-        for i in range(REPEATED_CALLS):
-            intent_str = make_openai_call("intent_value_creation", prompt=full_prompt)
+        # The calls are independent, so are sampled together in a single request
+        intent_strs = make_openai_calls("intent_value_creation", full_prompt, REPEATED_CALLS)
+
+        for i, intent_str in enumerate(intent_strs):
             try:
                 intent = json.loads(intent_str)
                 valid_values, reason = self.validate(intent, intent_no_values)
@@ -0,0 +1,44 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""The rules compile_data uses to truncate conversations with errors.
+
+A conversation is only kept up to the user turn after its last checkpoint, before the first
+system turn with errors. SSAConversation follows the same rules, to stop or roll back as soon
+as the rest of a conversation would be discarded. Turns are identified by their author and
+expression, and by their index in the conversation's list of turns, as saved for compile_data.
+
+compile_data is run as a script and imports this module directly, so it only uses the
+standard library.
+"""
+
+# A conversation without a checkpoint is kept up to the last user turn before an error,
+# .. if that is past this turn index
+MIN_TURNS_TO_RETRIEVE_CONVO = 10
+# Turns are checkpoints when their expression starts with the prefix for their author
+CHECKPOINT_PREFIXES = {"System": "find_", "AutoTurn": "perform("}
+
+
+def is_checkpoint(author: str, expression: str) -> bool:
+    prefix = CHECKPOINT_PREFIXES.get(author)
+    return prefix is not None and expression.startswith(prefix)
+
+
+def predicts_hint(expression: str) -> bool:
+    """
+    System labels should never predict a hint
+    """
+    return "hint" in expression.lower()
+
+
+def has_empty_str(expression: str) -> bool:
+    """
+    String slots should never be empty
+    """
+    return '=""' in expression or "=''" in expression
+
+
+def can_keep_without_checkpoint(last_user_turn_index: int) -> bool:
+    return last_user_turn_index > MIN_TURNS_TO_RETRIEVE_CONVO
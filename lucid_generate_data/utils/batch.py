@@ -0,0 +1,355 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""Batch submission of chat completion requests, for stages that don't need an interactive answer.
+
+Requests for the configured stages are collected, written to a JSONL batch file and handed to
+a batch backend. Each request waits on its own result, so the stage that made it resumes as soon
+as that result comes back. Settings come from the `batch` section of the pipeline YAML, e.g.
+
+    batch:
+      stages: [intent_value_creation, create_intent_json]  # stage names passed to complete()
+      backend: openai  # openai (the Batch API) or local (sends each request to the chat API)
+      dir: lucid_generate_data/batches
+      max_batch_size: 1000  # requests per batch file
+      flush_seconds: 5  # how long to collect requests before submitting a batch
+      poll_seconds: 30
+
+and can be overridden with the LUCID_BATCH_STAGES (comma separated) and LUCID_BATCH_BACKEND env variables.
+
+A batch can take up to a day to complete, so only stages that nothing is waiting on turn by turn
+should be batched (e.g. creating intents), and not those in TURN_LOOP_STAGES.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# aiohttp is declared in pyproject.toml, for the HTTP session shared with the completers
+import aiohttp
+import openai
+
+BATCH_BACKENDS = ("openai", "local")
+BATCH_ENDPOINT = "/v1/chat/completions"
+DEFAULT_BATCH_DIR = Path("lucid_generate_data/batches")
+# Every conversation turn waits on these, so batching them stalls each turn for a whole batch
+TURN_LOOP_STAGES = (
+    "system_turn",
+    "system_turn_validation",
+    "system_turn_cheating",
+    "user_turn",
+    "get_slot_values",
+    "demo_response",
+)
+
+
+class BatchError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class BatchConfig:
+    stages: Tuple[str, ...] = ()
+    backend: str = "openai"
+    batch_dir: Path = DEFAULT_BATCH_DIR
+    max_batch_size: int = 1000
+    flush_seconds: float = 5.0
+    poll_seconds: float = 30.0
+
+
+def make_batch_config(section: Optional[Dict[str, Any]] = None) -> BatchConfig:
+    """Builds the config from a YAML `batch` section, with env variables taking precedence."""
+    section = dict(section or {})
+    config = BatchConfig(
+        stages=tuple(section.pop("stages", None) or ()),
+        backend=section.pop("backend", "openai"),
+        batch_dir=Path(section.pop("dir", DEFAULT_BATCH_DIR)),
+        max_batch_size=int(section.pop("max_batch_size", 1000)),
+        flush_seconds=float(section.pop("flush_seconds", 5.0)),
+        poll_seconds=float(section.pop("poll_seconds", 30.0)),
+    )
+    if section:
+        raise ValueError(f"Unknown batch settings: {', '.join(section)}")
+
+    if "LUCID_BATCH_STAGES" in os.environ:
+        stages = tuple(stage for stage in os.environ["LUCID_BATCH_STAGES"].split(",") if stage)
+        config = replace(config, stages=stages)
+    if "LUCID_BATCH_BACKEND" in os.environ:
+        config = replace(config, backend=os.environ["LUCID_BATCH_BACKEND"])
+
+    if config.backend not in BATCH_BACKENDS:
+        raise ValueError(
+            f"Unknown batch backend {config.backend}, expected one of {BATCH_BACKENDS}"
+        )
+    turn_loop_stages = [stage for stage in config.stages if stage in TURN_LOOP_STAGES]
+    if turn_loop_stages and config.backend == "openai":
+        print(
+            f"WARNING: Batching {', '.join(turn_loop_stages)} will hold up every conversation turn "
+            "until its batch completes"
+        )
+    return config
+
+
+class BatchBackend(ABC):
+    """Runs the requests in a batch file."""
+
+    @abstractmethod
+    async def submit(self, batch_path: Path) -> str:
+        """Starts running the batch, returning its id."""
+
+    @abstractmethod
+    async def poll(self, batch_id: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """Returns the results that are newly available, and if the batch is finished.
+
+        Results are in the Batch API output format: {"custom_id", "response": {"body"}, "error"}.
+        """
+
+    async def wait(self, batch_id: str, seconds: float) -> None:
+        """Waits before polling again (backends that know when results arrive can return sooner)."""
+        await asyncio.sleep(seconds)
+
+
+class LocalBatchBackend(BatchBackend):
+    """Stand-in backend that sends each request in the batch to complete_fn (by default, the chat API).
+
+    Useful for testing the batch path, though it gets none of the batch pricing.
+    """
+
+    def __init__(self, complete_fn: Optional[Callable[..., Awaitable[Dict[str, Any]]]] = None):
+        self._complete_fn = complete_fn or openai.ChatCompletion.acreate
+        self._results: Dict[str, List[Dict[str, Any]]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._new_results: Dict[str, asyncio.Event] = {}
+
+    async def _run_request(self, batch_id: str, request: Dict[str, Any]) -> None:
+        try:
+            body = await self._complete_fn(**request["body"])
+            result = {"custom_id": request["custom_id"], "response": {"body": body}, "error": None}
+        except Exception as e:
+            result = {"custom_id": request["custom_id"], "response": None, "error": repr(e)}
+        self._results[batch_id].append(result)
+        self._new_results[batch_id].set()
+
+    async def submit(self, batch_path: Path) -> str:
+        with open(batch_path, "r") as rf:
+            requests = [json.loads(line) for line in rf]
+
+        batch_id = batch_path.stem
+        self._results[batch_id] = []
+        self._new_results[batch_id] = asyncio.Event()
+        self._tasks[batch_id] = asyncio.ensure_future(
+            asyncio.gather(*(self._run_request(batch_id, request) for request in requests))
+        )
+        return batch_id
+
+    async def poll(self, batch_id: str) -> Tuple[List[Dict[str, Any]], bool]:
+        finished = self._tasks[batch_id].done()
+        results, self._results[batch_id] = self._results[batch_id], []
+        self._new_results[batch_id].clear()
+        if finished:
+            del self._tasks[batch_id], self._results[batch_id], self._new_results[batch_id]
+        return results, finished
+
+    async def wait(self, batch_id: str, seconds: float) -> None:
+        # Results are handed over as soon as they arrive, rather than at the next poll
+        try:
+            await asyncio.wait_for(self._new_results[batch_id].wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+
+class OpenAiBatchBackend(BatchBackend):
+    """Submits batches to the OpenAI Batch API (results are available once the whole batch is done)."""
+
+    def __init__(self) -> None:
+        self._api_base = openai.api_base.rstrip("/")
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {os.environ['OPENAI_API_KEY']}"}
+
+    async def _request(self, method: str, path: str, **kwargs: Any) -> Any:
+        # Requests go through the completers' shared session, rather than a session of their own
+        from lucid_generate_data.utils.completer import get_http_session
+
+        async with get_http_session().request(
+            method, self._api_base + path, headers=self._headers(), **kwargs
+        ) as response:
+            if response.status != 200:
+                raise BatchError(f"Batch API error {response.status}: {await response.text()}")
+            if path.endswith("/content"):
+                return await response.text()
+            return await response.json()
+
+    async def submit(self, batch_path: Path) -> str:
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        form.add_field("file", batch_path.read_bytes(), filename=batch_path.name)
+        uploaded = await self._request("POST", "/files", data=form)
+
+        batch = await self._request(
+            "POST",
+            "/batches",
+            json={
+                "input_file_id": uploaded["id"],
+                "endpoint": BATCH_ENDPOINT,
+                "completion_window": "24h",
+            },
+        )
+        return batch["id"]
+
+    async def poll(self, batch_id: str) -> Tuple[List[Dict[str, Any]], bool]:
+        batch = await self._request("GET", f"/batches/{batch_id}")
+        if batch["status"] in ("failed", "expired", "cancelled"):
+            raise BatchError(f"Batch {batch_id} {batch['status']}: {batch.get('errors')}")
+        if batch["status"] != "completed":
+            return [], False
+
+        results = []
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if file_id:
+                content = await self._request("GET", f"/files/{file_id}/content")
+                results += [json.loads(line) for line in content.splitlines() if line.strip()]
+        return results, True
+
+
+class BatchCollector:
+    """Collects requests into batch files, and resolves each request's future when its result arrives."""
+
+    def __init__(self, config: BatchConfig, backend: BatchBackend):
+        self.config = config
+        self.backend = backend
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._num_requests = 0
+        self._num_batches = 0
+        self._polling: set = set()
+
+    async def complete(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Adds a chat completion request to the next batch, returning the response once it is done."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self._num_requests += 1
+        request = {
+            "custom_id": f"request-{self._num_requests}",
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body,
+        }
+        self._pending.append((request, future))
+
+        if len(self._pending) >= self.config.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            # We wait a little before submitting, so requests made around the same time share a batch
+            self._flush_handle = loop.call_later(self.config.flush_seconds, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        self._num_batches += 1
+        task = asyncio.ensure_future(self._run_batch(pending, self._num_batches))
+        # We keep a reference to the task, so it is not garbage collected while running
+        self._polling.add(task)
+        task.add_done_callback(self._polling.discard)
+
+    async def _run_batch(
+        self, pending: List[Tuple[Dict[str, Any], asyncio.Future]], batch_no: int
+    ) -> None:
+        futures = {request["custom_id"]: future for request, future in pending}
+        try:
+            self.config.batch_dir.mkdir(exist_ok=True, parents=True)
+            batch_name = f"batch_{int(time.time())}_{os.getpid()}_{batch_no}.jsonl"
+            batch_path = self.config.batch_dir / batch_name
+            with open(batch_path, "w") as wf:
+                for request, _ in pending:
+                    wf.write(json.dumps(request) + "\n")
+
+            batch_id = await self.backend.submit(batch_path)
+            print(f"Submitted batch {batch_id} of {len(pending)} requests ({batch_path})")
+
+            finished = False
+            while not finished:
+                results, finished = await self.backend.poll(batch_id)
+                for result in results:
+                    self._resolve(futures.pop(result["custom_id"], None), result)
+                if not finished:
+                    await self.backend.wait(batch_id, self.config.poll_seconds if futures else 0)
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(BatchError(f"Batch failed: {repr(e)}"))
+        else:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(BatchError("No result returned for request in batch"))
+
+    @staticmethod
+    def _resolve(future: Optional[asyncio.Future], result: Dict[str, Any]) -> None:
+        if future is None or future.done():
+            return
+        response = result.get("response") or {}
+        if result.get("error") or "body" not in response:
+            future.set_exception(BatchError(f"Batch request failed: {result.get('error')}"))
+        else:
+            future.set_result(response["body"])
+
+
+_config: Optional[BatchConfig] = None
+_backend: Optional[BatchBackend] = None
+_collectors: Dict[asyncio.AbstractEventLoop, BatchCollector] = {}
+_lock = threading.Lock()
+
+
+def configure_batch(
+    section: Optional[Dict[str, Any]] = None, backend: Optional[BatchBackend] = None
+) -> BatchConfig:
+    """Sets the batch config for this process, from a YAML `batch` section (and optionally the backend)."""
+    global _config, _backend
+    config = make_batch_config(section)
+    with _lock:
+        _config = config
+        _backend = backend
+        _collectors.clear()
+    return config
+
+
+def get_batch_config() -> BatchConfig:
+    global _config
+    with _lock:
+        if _config is None:
+            _config = make_batch_config()
+        return _config
+
+
+def is_batched(stage_name: Optional[str]) -> bool:
+    return stage_name is not None and stage_name in get_batch_config().stages
+
+
+def get_batch_collector() -> BatchCollector:
+    """Returns the collector for the running event loop."""
+    config = get_batch_config()
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _collectors:
+            backend = _backend
+            if backend is None:
+                backend = LocalBatchBackend() if config.backend == "local" else OpenAiBatchBackend()
+            _collectors[loop] = BatchCollector(config, backend)
+        return _collectors[loop]
@@ -0,0 +1,248 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""Storage for completion caches: an in-memory LRU tier in front of a size-bounded disk tier.
+
+Settings come from the `cache` section of the pipeline YAML, e.g.
+
+    cache:
+      dir: ~/.cache/lucid
+      size_limit: 1000000000  # bytes
+      eviction_policy: lru  # lru, lfu, lrs (least recently stored) or none
+      memory_items: 1024
+      ttl: null  # seconds, for every stage without a stage_ttl
+      stage_ttl:
+        find_intent_path: 86400
+      store_prompts: false  # keep the full prompt of each entry, for debugging
+
+and can be overridden with the LUCID_CACHE_DIR, LUCID_CACHE_SIZE_LIMIT,
+LUCID_CACHE_EVICTION_POLICY, LUCID_CACHE_MEMORY_ITEMS, LUCID_CACHE_TTL and
+LUCID_CACHE_STORE_PROMPTS env variables.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from diskcache import Cache
+
+EVICTION_POLICIES = {
+    "lru": "least-recently-used",
+    "lfu": "least-frequently-used",
+    "lrs": "least-recently-stored",
+    "none": "none",
+}
+DEFAULT_CACHE_DIR = Path("~/.cache/lucid")
+DEFAULT_SIZE_LIMIT = 2**30
+DEFAULT_MEMORY_ITEMS = 1024
+
+
+@dataclass(frozen=True)
+class CacheConfig:
+    cache_dir: Path = DEFAULT_CACHE_DIR
+    size_limit: int = DEFAULT_SIZE_LIMIT
+    eviction_policy: str = "lru"
+    memory_items: int = DEFAULT_MEMORY_ITEMS
+    ttl: Optional[float] = None
+    stage_ttl: Tuple[Tuple[str, float], ...] = ()
+    store_prompts: bool = False
+
+    def ttl_for(self, stage_name: Optional[str]) -> Optional[float]:
+        return dict(self.stage_ttl).get(stage_name, self.ttl)
+
+
+@dataclass
+class CacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    memory_evictions: int = 0
+    disk_evictions: int = 0
+    disk_bytes: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+
+def _config_from_env(config: CacheConfig) -> CacheConfig:
+    env_overrides: Dict[str, Any] = {}
+    if "LUCID_CACHE_DIR" in os.environ:
+        env_overrides["cache_dir"] = Path(os.environ["LUCID_CACHE_DIR"])
+    if "LUCID_CACHE_SIZE_LIMIT" in os.environ:
+        env_overrides["size_limit"] = int(os.environ["LUCID_CACHE_SIZE_LIMIT"])
+    if "LUCID_CACHE_EVICTION_POLICY" in os.environ:
+        env_overrides["eviction_policy"] = os.environ["LUCID_CACHE_EVICTION_POLICY"]
+    if "LUCID_CACHE_MEMORY_ITEMS" in os.environ:
+        env_overrides["memory_items"] = int(os.environ["LUCID_CACHE_MEMORY_ITEMS"])
+    if "LUCID_CACHE_TTL" in os.environ:
+        env_overrides["ttl"] = float(os.environ["LUCID_CACHE_TTL"])
+    if "LUCID_CACHE_STORE_PROMPTS" in os.environ:
+        env_overrides["store_prompts"] = os.environ["LUCID_CACHE_STORE_PROMPTS"].lower() in ("1", "true")
+    return replace(config, **env_overrides)
+
+
+def make_cache_config(section: Optional[Dict[str, Any]] = None) -> CacheConfig:
+    """Builds the config from a YAML `cache` section, with env variables taking precedence."""
+    section = dict(section or {})
+    config = CacheConfig(
+        cache_dir=Path(section.pop("dir", DEFAULT_CACHE_DIR)),
+        size_limit=int(section.pop("size_limit", DEFAULT_SIZE_LIMIT)),
+        eviction_policy=section.pop("eviction_policy", "lru"),
+        memory_items=int(section.pop("memory_items", DEFAULT_MEMORY_ITEMS)),
+        ttl=section.pop("ttl", None),
+        stage_ttl=tuple(sorted(section.pop("stage_ttl", {}).items())),
+        store_prompts=bool(section.pop("store_prompts", False)),
+    )
+    if section:
+        raise ValueError(f"Unknown cache settings: {', '.join(section)}")
+
+    config = _config_from_env(config)
+    if config.eviction_policy not in EVICTION_POLICIES:
+        raise ValueError(
+            f"Unknown eviction policy {config.eviction_policy}, expected one of {list(EVICTION_POLICIES)}"
+        )
+    return replace(config, cache_dir=config.cache_dir.expanduser())
+
+
+class MemoryTier:
+    """A bounded LRU map, holding values until their expiry time."""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._items: OrderedDict[Any, Tuple[Any, Optional[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Tuple[Optional[Any], int]:
+        """Returns the value (or None) and the number of items evicted as expired."""
+        with self._lock:
+            if key not in self._items:
+                return None, 0
+            value, expires_at = self._items[key]
+            if expires_at is not None and expires_at <= time.time():
+                del self._items[key]
+                return None, 1
+            self._items.move_to_end(key)
+            return value, 0
+
+    def set(self, key: Any, value: Any, expires_at: Optional[float]) -> int:
+        """Stores the value, returning the number of items evicted to make room."""
+        if self.max_items <= 0:
+            return 0
+
+        num_evicted = 0
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                num_evicted += 1
+        return num_evicted
+
+
+class CacheStore:
+    """Memory and disk tiers for a single cache directory, shared by every completer using it."""
+
+    def __init__(self, config: CacheConfig, cache_dir: Path):
+        self.config = config
+        cache_dir.mkdir(exist_ok=True, parents=True)
+        assert cache_dir.is_dir()
+
+        # We cull manually after each write (cull_limit=0), so that evictions can be counted
+        self._disk = Cache(
+            str(cache_dir),
+            size_limit=config.size_limit,
+            eviction_policy=EVICTION_POLICIES[config.eviction_policy],
+            cull_limit=0,
+        )
+        self._memory = MemoryTier(config.memory_items)
+        self._stats = CacheStats()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, **increments: int) -> None:
+        with self._stats_lock:
+            for name, increment in increments.items():
+                setattr(self._stats, name, getattr(self._stats, name) + increment)
+
+    def get(self, key: Any) -> Optional[Any]:
+        value, num_expired = self._memory.get(key)
+        if value is not None:
+            self._count(memory_hits=1)
+            return value
+
+        value, expires_at = self._disk.get(key, expire_time=True)
+        if value is None:
+            self._count(misses=1, memory_evictions=num_expired)
+            return None
+
+        self._count(disk_hits=1, memory_evictions=num_expired + self._memory.set(key, value, expires_at))
+        return value
+
+    def set(self, key: Any, value: Any, stage_name: Optional[str] = None) -> None:
+        ttl = self.config.ttl_for(stage_name)
+        expires_at = time.time() + ttl if ttl is not None else None
+
+        self._disk.set(key, value, expire=ttl)
+        num_culled = self._disk.cull() if self.config.eviction_policy != "none" else 0
+
+        self._count(memory_evictions=self._memory.set(key, value, expires_at), disk_evictions=num_culled)
+
+    def set_prompt(self, key: str, prompt: str, stage_name: Optional[str] = None) -> None:
+        """Keeps the full prompt for an entry (only with store_prompts), for debugging."""
+        if self.config.store_prompts:
+            self._disk.set(("prompt", key), prompt, expire=self.config.ttl_for(stage_name))
+
+    def get_prompt(self, key: str) -> Optional[str]:
+        return self._disk.get(("prompt", key))
+
+    def stats(self) -> CacheStats:
+        with self._stats_lock:
+            return replace(self._stats, disk_bytes=self._disk.volume())
+
+
+_config: Optional[CacheConfig] = None
+_stores: Dict[Path, CacheStore] = {}
+_lock = threading.Lock()
+
+
+def configure_cache(section: Optional[Dict[str, Any]] = None) -> CacheConfig:
+    """Sets the cache config for this process, from a YAML `cache` section."""
+    global _config
+    config = make_cache_config(section)
+    with _lock:
+        if config != _config:
+            # Stores opened with the old settings are reopened on next use
+            _config = config
+            _stores.clear()
+    return config
+
+
+def get_cache_config() -> CacheConfig:
+    global _config
+    with _lock:
+        if _config is None:
+            _config = make_cache_config()
+        return _config
+
+
+def get_cache_store(subdir: str) -> CacheStore:
+    """Returns the store for a subdirectory of the configured cache directory."""
+    config = get_cache_config()
+    cache_dir = config.cache_dir / subdir
+    with _lock:
+        if cache_dir not in _stores:
+            _stores[cache_dir] = CacheStore(config, cache_dir)
+        return _stores[cache_dir]
+
+
+def get_cache_stats() -> Dict[Path, CacheStats]:
+    with _lock:
+        stores = dict(_stores)
+    return {cache_dir: store.stats() for cache_dir, store in stores.items()}
@@ -0,0 +1,59 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""Checkpoints of pipeline traces, so an interrupted run can resume from its last completed stage."""
+import os
+import pickle
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class Checkpoint:
+    trace: Dict[str, Any]
+    completed_stages: List[str] = field(default_factory=list)
+    # Set once the caller has saved the trace's result, after which it need not be run again
+    finished: bool = False
+
+
+class CheckpointStore:
+    """Stores a checkpoint file per trace id in a local directory."""
+
+    def __init__(self, checkpoint_dir: Path):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.checkpoint_dir.mkdir(exist_ok=True, parents=True)
+
+    def _path(self, trace_id: str) -> Path:
+        return self.checkpoint_dir / f"{trace_id}.pkl"
+
+    def load(self, trace_id: str) -> Optional[Checkpoint]:
+        path = self._path(trace_id)
+        if not path.exists():
+            return None
+        with open(path, "rb") as rf:
+            return pickle.load(rf)
+
+    def save(self, trace_id: str, checkpoint: Checkpoint) -> None:
+        # We write to a temporary file and then rename it, so a crash never leaves a partial checkpoint
+        fd, tmp_path = tempfile.mkstemp(dir=self.checkpoint_dir, prefix=f".{trace_id}.")
+        try:
+            with os.fdopen(fd, "wb") as wf:
+                pickle.dump(checkpoint, wf)
+            os.replace(tmp_path, self._path(trace_id))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def mark_finished(self, trace_id: str) -> None:
+        """Keeps a record that the trace is finished, dropping its (now saved) contents."""
+        checkpoint = self.load(trace_id)
+        completed_stages = checkpoint.completed_stages if checkpoint is not None else []
+        self.save(trace_id, Checkpoint(trace={}, completed_stages=completed_stages, finished=True))
+
+    def is_finished(self, trace_id: str) -> bool:
+        checkpoint = self.load(trace_id)
+        return checkpoint is not None and checkpoint.finished
@@ -6,20 +6,30 @@
 """Completion of prompts (using large language models)."""
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import os
 import time
+import weakref
 from abc import ABC, abstractmethod
-from pathlib import Path
+from functools import partial
 from typing import Any, Awaitable, Callable, Dict, List, Optional, cast
-from pathlib import Path
 
+import aiohttp
 import openai
-from diskcache import Cache
 from openai import OpenAIError
+from openai.error import RateLimitError
 from pydantic import BaseModel
 
+from lucid_generate_data.utils.batch import BatchError, get_batch_collector, is_batched
+from lucid_generate_data.utils.cache import CacheStore, get_cache_store
+from lucid_generate_data.utils.metrics import metric_labels, record
+from lucid_generate_data.utils.rate_limiter import backoff_delay, estimate_tokens, get_rate_limiter
+from lucid_generate_data.utils.replay import replayed_complete, replayed_complete_many
+
 RATE_LIMIT_RETRIES = 5
-DEFAULT_CACHE_DIR = Path("/Users/joestacey/.cache/lucid")
+# Bump this when the key scheme (or prompt format) changes, so that old entries are not used
+CACHE_KEY_VERSION = "v1"
 
 
 class Prompt(BaseModel):
@@ -54,14 +64,63 @@ class Completer(ABC):
 
     _cache: CompletionCache
 
-    async def complete(self, prompt: Prompt, use_cache: bool = True, max_retries: int = 1) -> str:
-        """Complete the prompt, using the cache."""
-        return await self._cache.cached_complete(self._complete, prompt, use_cache, max_retries)
+    async def complete(
+        self,
+        prompt: Prompt,
+        use_cache: bool = True,
+        max_retries: int = 1,
+        stage_name: Optional[str] = None,
+    ) -> str:
+        """Complete the prompt, using the cache (or a recorded completion, when replaying)."""
+        with metric_labels(llm_stage=stage_name):
+            return await replayed_complete(
+                stage_name,
+                prompt,
+                lambda: self._cache.cached_complete(
+                    partial(self._complete, stage_name=stage_name),
+                    prompt,
+                    use_cache,
+                    max_retries,
+                    stage_name,
+                ),
+            )
+
+    async def complete_many(
+        self,
+        prompt: Prompt,
+        n: int,
+        use_cache: bool = True,
+        max_retries: int = 1,
+        stage_name: Optional[str] = None,
+    ) -> List[str]:
+        """Complete the prompt n times in one request, returning every completion."""
+        with metric_labels(llm_stage=stage_name):
+            return await replayed_complete_many(
+                stage_name,
+                prompt,
+                n,
+                lambda: self._cache.cached_complete(
+                    partial(self._complete_many, n=n, stage_name=stage_name),
+                    prompt,
+                    use_cache,
+                    max_retries,
+                    stage_name,
+                    num_samples=n,
+                ),
+            )
 
     @abstractmethod
-    async def _complete(self, prompt: Prompt) -> str:
+    async def _complete(self, prompt: Prompt, stage_name: Optional[str] = None) -> str:
         """Implementation of prompt completion, used by self.complete."""
 
+    async def _complete_many(
+        self, prompt: Prompt, n: int, stage_name: Optional[str] = None
+    ) -> List[str]:
+        """Implementation of self.complete_many, for completers that can only sample one at a time."""
+        return list(
+            await asyncio.gather(*(self._complete(prompt, stage_name) for _ in range(n)))
+        )
+
     async def get_prompt(self) -> Prompt:
         """Returns a prompt to complete."""
         raise CompletionGetPromptError("get_prompt not implemented for this completer")
@@ -71,40 +130,46 @@ class Completer(ABC):
         pass
 
 
-def _make_cache_key(prompt: Prompt) -> str:
-    return prompt.json()
+def _make_cache_key(namespace: str, prompt_json: str) -> str:
+    # Prompts can be many kilobytes, so we only key on their hash
+    prompt_hash = hashlib.sha256(f"{namespace}\n{prompt_json}".encode()).hexdigest()
+    return f"{CACHE_KEY_VERSION}:{prompt_hash}"
 
 
 class CompletionCache:
     """A cache for completion results, that can be used by Completer implementations.
     Also implements retrying.
-    """
 
-    def __init__(self, cache_dir: Optional[Path]):
-        self._cache = self._make_cache(cache_dir)
+    Completers with different settings share a store, and are kept apart by namespace.
+    """
 
-    @staticmethod
-    def _make_cache(cache_dir: Optional[Path]) -> Optional[Cache]:
-        if cache_dir is None:
-            return None
-        cache_dir.mkdir(exist_ok=True, parents=True)
-        assert cache_dir.is_dir()
-        return Cache(str(cache_dir))
+    def __init__(self, namespace: str, store: Optional[CacheStore]):
+        self._namespace = namespace
+        self._cache = store
 
     async def cached_complete(
         self,
-        complete_fn: Callable[[Prompt], Awaitable[str]],
+        complete_fn: Callable[[Prompt], Awaitable[Any]],
         prompt: Prompt,
         use_cache: bool = True,
         max_retries: int = 1,
-    ) -> str:
-        """Use the given complete_fn, or return a cached completion."""
-        key = _make_cache_key(prompt)
+        stage_name: Optional[str] = None,
+        num_samples: int = 1,
+    ) -> Any:
+        """Use the given complete_fn, or return a cached completion.
+
+        With num_samples > 1, complete_fn returns a list of completions, which is cached as a whole.
+        """
+        prompt_json = prompt.json()
+        namespace = self._namespace if num_samples == 1 else f"{self._namespace}__samples_{num_samples}"
+        key = _make_cache_key(namespace, prompt_json)
         if self._cache is not None and use_cache:
-            if key in self._cache:
-                return cast(str, self._cache[key])
+            completion = self._cache.get(key)
+            if completion is not None:
+                record("cache_hit")
+                return completion
 
-        completion: Optional[str] = None
+        completion: Optional[Any] = None
         for i in range(max_retries):
             try:
                 completion = await complete_fn(prompt)
@@ -115,11 +180,47 @@ class CompletionCache:
 
         assert completion is not None
         if self._cache is not None:
-            self._cache[key] = completion
+            self._cache.set(key, completion, stage_name)
+            self._cache.set_prompt(key, prompt_json, stage_name)
 
         return completion
 
 
+# One HTTP session (and so one pool of keep-alive connections) per event loop
+_http_sessions: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, aiohttp.ClientSession
+] = weakref.WeakKeyDictionary()
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Returns the HTTP session shared by all requests made on the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _http_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession()
+        _http_sessions[loop] = session
+    return session
+
+
+async def close_http_session() -> None:
+    session = _http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def _is_rate_limit_error(error: OpenAIError) -> bool:
+    return isinstance(error, RateLimitError) or "Rate limit" in str(error)
+
+
+def _get_retry_after(error: OpenAIError) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None
+
+
 class OpenAiChatCompleter(Completer):
     def __init__(
         self,
@@ -127,60 +228,153 @@ class OpenAiChatCompleter(Completer):
         max_tokens: int = 100,
         best_of_n: int = 1,
         temperature: float = 0.7,
-        cache_dir: Optional[Path] = DEFAULT_CACHE_DIR / "openai",
+        cache_subdir: Optional[str] = "openai",
     ):
         self._model_name = model_name
         self._max_tokens = max_tokens
         self._best_of_n = best_of_n
         self._temperature = temperature
-        self._cache = CompletionCache(self._full_cache_dir(cache_dir))
+        self._cache = CompletionCache(
+            self._cache_namespace(),
+            get_cache_store(cache_subdir) if cache_subdir is not None else None,
+        )
         if "OPENAI_API_KEY" not in os.environ:
             raise RuntimeError(f"Set OPENAI_API_KEY env variable to use {self.__class__.__name__}")
 
-    def _full_cache_dir(self, cache_dir: Optional[Path]) -> Optional[Path]:
-        if cache_dir is None:
-            return None
+    def _cache_namespace(self) -> str:
         return (
-            cache_dir
-            / f"chat__{self._model_name}"
-            / f"mt_{self._max_tokens}__n_{self._best_of_n}__temp_{self._temperature:.3f}"
+            f"chat__{self._model_name}"
+            f"/mt_{self._max_tokens}__n_{self._best_of_n}__temp_{self._temperature:.3f}"
         )
 
-    async def _complete(self, prompt: Prompt) -> str:
+    async def _complete(self, prompt: Prompt, stage_name: Optional[str] = None) -> str:
         """Implementation that is wrapped by `complete`, potentially cached."""
+        response = await self._send(prompt, self._best_of_n, stage_name)
+        if not len(response.get("choices", [])) >= 1:
+            raise CompletionApiError("No completion returned from API")
+
+        return self._choice_text(prompt, response["choices"][0])
+
+    async def _complete_many(
+        self, prompt: Prompt, n: int, stage_name: Optional[str] = None
+    ) -> List[str]:
+        """Implementation that is wrapped by `complete_many`, potentially cached."""
+        response = await self._send(prompt, n, stage_name)
+
+        # We keep the choices that are usable, rather than failing all of them for one
+        texts = []
+        for choice in response.get("choices", []):
+            try:
+                texts.append(self._choice_text(prompt, choice))
+            except CompletionTooShortError:
+                continue
+        if not texts:
+            raise CompletionApiError("No usable completion returned from API")
+
+        return texts
+
+    async def _send(self, prompt: Prompt, n: int, stage_name: Optional[str]) -> Dict[str, Any]:
         if prompt.start_text:
             raise ValueError(f"Start text is not implemented for OpenAiChatCompleter.")
 
+        request = dict(
+            model=self._model_name,
+            messages=[{"role": "system", "content": prompt.prefix}],
+            temperature=self._temperature,
+            max_tokens=self._max_tokens,
+            stop=prompt.stop_texts,
+            n=n,
+        )
+        if is_batched(stage_name):
+            return await self._batch_request(request)
+        return await self._request(request)
+
+    async def _batch_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        # Batches have their own quota, so are not held back by the rate limiter
+        request_start = time.perf_counter()
+        try:
+            response = await get_batch_collector().complete(request)
+        except BatchError as e:
+            record(
+                "llm_call",
+                model=self._model_name,
+                seconds=time.perf_counter() - request_start,
+                status="failed",
+                batched=True,
+            )
+            raise CompletionApiError(f"BatchError: {repr(e)}")
+
+        usage = response.get("usage") or {}
+        record(
+            "llm_call",
+            model=self._model_name,
+            seconds=time.perf_counter() - request_start,
+            status="ok",
+            batched=True,
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+            total_tokens=usage.get("total_tokens", 0),
+        )
+        return response
+
+    async def _request(self, request: Dict[str, Any]) -> Dict[str, Any]:
         response: Optional[Dict[str, Any]] = None
 
-        retries = 10
+        rate_limiter = get_rate_limiter(self._model_name)
+        estimated_tokens = (
+            estimate_tokens(request["messages"][0]["content"]) + self._max_tokens * request["n"]
+        )
 
+        rate_limit_wait = 0.0
         for attempt in range(RATE_LIMIT_RETRIES + 1):
+            rate_limit_wait += await rate_limiter.acquire(estimated_tokens)
+            request_start = time.perf_counter()
+            # openai reads the session from a context variable, which we only set for this request
+            session_token = openai.aiosession.set(get_http_session())
             try:
-                response = await openai.ChatCompletion.acreate(
-                    model=self._model_name,
-                    messages=[{"role": "system", "content": prompt.prefix}],
-                    temperature=self._temperature,
-                    max_tokens=self._max_tokens,
-                    stop=prompt.stop_texts,
-                    n=self._best_of_n,
-                )
+                response = await openai.ChatCompletion.acreate(**request)
             except OpenAIError as e:
-                if "Rate limit" in str(e) and attempt != RATE_LIMIT_RETRIES:
+                if _is_rate_limit_error(e) and attempt != RATE_LIMIT_RETRIES:
+                    # Other requests to this model are held back too, rather than adding to the load
+                    delay = backoff_delay(attempt, _get_retry_after(e))
+                    rate_limiter.pause(delay)
                     print(
-                        f"\nOpenAI Rate limit reached. Waiting for 1 minute before retrying. (number of retries remaining: {RATE_LIMIT_RETRIES-(attempt+1)})\n"
+                        f"\nOpenAI Rate limit reached. Waiting for {delay:.1f} seconds before retrying. (number of retries remaining: {RATE_LIMIT_RETRIES-(attempt+1)})\n"
                     )
-                    time.sleep(60)
                 else:
+                    record(
+                        "llm_call",
+                        model=self._model_name,
+                        seconds=time.perf_counter() - request_start,
+                        status="failed",
+                        retries=attempt,
+                        rate_limit_wait_seconds=rate_limit_wait,
+                    )
                     raise CompletionApiError(f"OpenAIError: {repr(e)}")
             else:
                 break
+            finally:
+                openai.aiosession.reset(session_token)
+
+        usage = response.get("usage")
+        if usage is not None:
+            rate_limiter.record_usage(estimated_tokens, usage["total_tokens"])
+
+        record(
+            "llm_call",
+            model=self._model_name,
+            seconds=time.perf_counter() - request_start,
+            status="ok",
+            retries=attempt,
+            rate_limit_wait_seconds=rate_limit_wait,
+            prompt_tokens=(usage or {}).get("prompt_tokens", 0),
+            completion_tokens=(usage or {}).get("completion_tokens", 0),
+            total_tokens=(usage or {}).get("total_tokens", 0),
+        )
+        return response
 
-        if not len(response.get("choices", [])) >= 1:
-            raise CompletionApiError("No completion returned from API")
-
-        top_completion = response["choices"][0]
-        message = top_completion["message"]
+    def _choice_text(self, prompt: Prompt, choice: Dict[str, Any]) -> str:
+        message = choice["message"]
         if message["role"] != "assistant":
             raise CompletionApiError(
                 f"API returned message with role '{message['role']}', expected to be 'assistant'."
@@ -191,7 +385,37 @@ class OpenAiChatCompleter(Completer):
         ends_with_stop_text = prompt.stop_texts and any(
             text.endswith(stop_text) for stop_text in prompt.stop_texts
         )
-        if top_completion.get("finish_reason") == "length" and not ends_with_stop_text:
+        if choice.get("finish_reason") == "length" and not ends_with_stop_text:
             raise CompletionTooShortError("API reached token limit before returning answer")
 
         return text
+
+
+class CompletionPool:
+    """Candidate completions for retry loops, sampled n at a time in a single request.
+
+    Each draw takes the next unused candidate for its prompt, so a loop retrying the same prompt
+    only goes back to the API once the candidates are used up.
+    """
+
+    def __init__(
+        self,
+        completer: Completer,
+        n: int,
+        stage_name: Optional[str] = None,
+        use_cache: bool = False,
+    ):
+        self.completer = completer
+        self.n = n
+        self.stage_name = stage_name
+        # Cached candidates would be the same on every refill, so caching is off by default
+        self.use_cache = use_cache
+        self._candidates: Dict[str, List[str]] = {}
+
+    async def next(self, prompt: Prompt) -> str:
+        key = prompt.json()
+        if not self._candidates.get(key):
+            self._candidates[key] = await self.completer.complete_many(
+                prompt, self.n, use_cache=self.use_cache, stage_name=self.stage_name
+            )
+        return self._candidates[key].pop(0)
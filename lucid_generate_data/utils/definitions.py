@@ -3,8 +3,10 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
+from __future__ import annotations
+
 from dataclasses import dataclass
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 
 AppContext = dict[str, Any]
 
@@ -50,6 +52,25 @@ class UserTurn(Turn):
     tags: list[str]
 
 
+class Transcript(list):
+    """The turns of a conversation.
+
+    Turns are only appended during generation, so a failed generation is undone by
+    rolling back to a checkpoint, rather than generating on a copy of the transcript.
+    """
+
+    @classmethod
+    def of(cls, turns: Iterable[Turn]) -> Transcript:
+        """Returns turns as a Transcript, wrapping (a shallow copy of) a plain list."""
+        return turns if isinstance(turns, Transcript) else cls(turns)
+
+    def checkpoint(self) -> int:
+        return len(self)
+
+    def rollback(self, checkpoint: int) -> None:
+        del self[checkpoint:]
+
+
 @dataclass
 class Inform:
     dialogue: str
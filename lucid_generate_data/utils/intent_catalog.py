@@ -0,0 +1,158 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""The app intents available for data generation, loaded once per process.
+
+Intents are loaded from the JSON files in INTENT_PATH, or from a single bundle file
+(a JSON list of intents) if LUCID_INTENT_BUNDLE is set. A bundle can be built with:
+
+    python -m lucid_generate_data.utils.intent_catalog <bundle path>
+"""
+import copy
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from os import listdir
+from os.path import isfile, join
+from typing import Any, Dict, List, Optional
+
+from lucid_generate_data.run_scripts.constants import INTENT_PATH
+
+INTENT_BUNDLE_PATH = os.environ.get("LUCID_INTENT_BUNDLE")
+QUERY_DATE_OF_EXP = [
+    "yesterday",
+    "most recent",
+    "last time",
+    "last week",
+    "last one",
+    "the one before last",
+    "last one",
+    "last month",
+    "Monday",
+    "Tuesday",
+    "the weekend",
+    "last weekend",
+]
+
+
+def make_query_version(app_intent: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    We derive the query intent (find_[entity_name]) for a transactional intent
+    """
+    query_intent = copy.deepcopy(app_intent)
+    query_intent["query_intent"] = True
+    query_name = "find_" + query_intent["entity_name"]
+    query_intent["command"] = query_name
+
+    # There are some differences between the query intent and the corresponding transactional intent
+    for slot_name, slot_dict in app_intent["args"].items():
+        # We avoid slots that will clash with date_of_entity
+        if "date" in slot_name or "time" in slot_name or "day" in slot_name:
+            del query_intent["args"][slot_name]
+        else:
+            query_intent["args"][slot_name]["optional"] = True
+
+    # We introduce a new slot called date_of_[entity_name], that has a standard set of initial values
+    entity_name = query_intent["entity_name"]
+    query_intent["args"].update(
+        {
+            f"date_of_{entity_name}": {
+                "type": "str",
+                "values": QUERY_DATE_OF_EXP,
+                "optional": False,
+            }
+        }
+    )
+
+    # Query intents do not require confirmation
+    query_intent["confirmation_required"] = False
+    query_intent["description"] = f"Query intent for finding existing {entity_name}"
+
+    return query_intent
+
+
+class IntentCatalog:
+    """Intents indexed by command and domain.
+
+    Lookups return copies, so callers are free to modify them.
+    """
+
+    def __init__(self, intents: List[Dict[str, Any]]):
+        self._intents = intents
+        self._by_command = {intent["command"]: intent for intent in intents}
+        self._query_versions = {
+            intent["command"]: make_query_version(intent) for intent in intents
+        }
+
+        self._by_domain: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for intent in intents:
+            self._by_domain[intent["domain"]].append(intent)
+
+    @classmethod
+    def from_directory(cls, path: str) -> "IntentCatalog":
+        intents = []
+        # We sort the files, so the catalog order (and sampling from it) is reproducible
+        for file in sorted(f for f in listdir(path) if isfile(join(path, f))):
+            if file[-5:] == ".json":
+                with open(join(path, file), "r") as json_file:
+                    intents.append(json.load(json_file))
+        return cls(intents)
+
+    @classmethod
+    def from_bundle(cls, path: str) -> "IntentCatalog":
+        with open(path, "r") as json_file:
+            return cls(json.load(json_file))
+
+    def save_bundle(self, path: str) -> None:
+        with open(path, "w") as json_file:
+            json.dump(self._intents, json_file)
+
+    @property
+    def intents(self) -> List[Dict[str, Any]]:
+        """All intents, shared with the catalog, so these must not be modified (see all())."""
+        return self._intents
+
+    @property
+    def commands(self) -> List[str]:
+        return list(self._by_command)
+
+    def all(self) -> List[Dict[str, Any]]:
+        return copy.deepcopy(self._intents)
+
+    def get(self, command: str) -> Dict[str, Any]:
+        if command not in self._by_command:
+            raise KeyError(f"No intent {command} in the catalog")
+        return copy.deepcopy(self._by_command[command])
+
+    def get_query_version(self, command: str) -> Dict[str, Any]:
+        """The query intent derived from the transactional intent `command`."""
+        if command not in self._query_versions:
+            raise KeyError(f"No intent {command} in the catalog")
+        return copy.deepcopy(self._query_versions[command])
+
+    def by_domain(self, domain: str) -> List[Dict[str, Any]]:
+        return copy.deepcopy(self._by_domain.get(domain, []))
+
+
+_catalog: Optional[IntentCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_intent_catalog() -> IntentCatalog:
+    """Returns the catalog for this process, loading it on first use."""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            if INTENT_BUNDLE_PATH:
+                _catalog = IntentCatalog.from_bundle(INTENT_BUNDLE_PATH)
+            else:
+                _catalog = IntentCatalog.from_directory(INTENT_PATH)
+        return _catalog
+
+
+if __name__ == "__main__":
+    IntentCatalog.from_directory(INTENT_PATH).save_bundle(sys.argv[1])
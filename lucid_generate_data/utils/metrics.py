@@ -0,0 +1,288 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""Metrics for generation runs, as a JSONL stream of events and an end-of-run summary.
+
+Events are recorded for traces, stages, LLM calls, cache and replay hits, system and user
+turns, and validations. Each event holds the labels active when it was recorded, such as
+the id of the trace (conversation) it belongs to.
+
+The stream is written to LUCID_METRICS_PATH if set (or to the path given to configure_metrics).
+The recorder only keeps running totals (and durations, for percentiles), not the events.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+METRICS_PATH = os.environ.get("LUCID_METRICS_PATH")
+
+_labels: ContextVar[Dict[str, Any]] = ContextVar("metric_labels", default={})
+
+
+@contextmanager
+def metric_labels(**labels: Any) -> Iterator[None]:
+    """Adds labels to every event recorded inside the block (including by tasks it starts)."""
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+class MetricsRecorder:
+    def __init__(self, path: Optional[Path] = None):
+        self._summary = _SummaryBuilder()
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            Path(path).parent.mkdir(exist_ok=True, parents=True)
+            self._file = open(path, "a")
+
+    def record(self, event: str, **fields: Any) -> None:
+        entry = {"event": event, "time": time.time(), **_labels.get(), **fields}
+        with self._lock:
+            self._summary.add(entry)
+            if self._file is not None:
+                self._file.write(json.dumps(entry, default=str) + "\n")
+                self._file.flush()
+
+    def summary(self) -> Dict[str, Any]:
+        """The summary of every event recorded so far (see summarize)."""
+        with self._lock:
+            return self._summary.build()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_recorder: Optional[MetricsRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def configure_metrics(path: Optional[Path] = None) -> MetricsRecorder:
+    """Starts a new recorder for this process, writing events to path (if given)."""
+    global _recorder
+    with _recorder_lock:
+        if _recorder is not None:
+            _recorder.close()
+        _recorder = MetricsRecorder(path)
+        return _recorder
+
+
+def get_metrics() -> MetricsRecorder:
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = MetricsRecorder(Path(METRICS_PATH) if METRICS_PATH else None)
+        return _recorder
+
+
+def record(event: str, **fields: Any) -> None:
+    get_metrics().record(event, **fields)
+
+
+@contextmanager
+def timed(event: str, **fields: Any) -> Iterator[Dict[str, Any]]:
+    """Records the event with its duration and status. The block can add fields to the yielded dict."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield fields
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        record(event, seconds=time.perf_counter() - start, status=status, **fields)
+
+
+def iter_events(path: Path) -> Iterator[Dict[str, Any]]:
+    """The events in a metrics file, read one at a time."""
+    with open(path, "r") as rf:
+        for line in rf:
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_events(path: Path) -> List[Dict[str, Any]]:
+    return list(iter_events(path))
+
+
+def _percentile(values: List[float], percentile: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+
+def _timing_summary(timing: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "count": len(timing["seconds"]),
+        "failed": timing["failed"],
+        "p50_seconds": _percentile(timing["seconds"], 50),
+        "p95_seconds": _percentile(timing["seconds"], 95),
+    }
+
+
+class _SummaryBuilder:
+    """Running totals of events, for summarize (only the durations are kept per event)."""
+
+    def __init__(self):
+        # Durations by event type, and by stage for stages and LLM calls
+        self.timings: Dict[Tuple[str, Optional[str]], Dict[str, Any]] = defaultdict(
+            lambda: {"seconds": [], "failed": 0}
+        )
+        self.llm_tokens: Dict[str, Counter] = defaultdict(Counter)
+        self.totals: Counter = Counter()
+        self.failed_checks: Counter = Counter()
+
+    def add(self, event: Dict[str, Any]) -> None:
+        event_type = event["event"]
+        if event_type in ("trace", "system_turn", "user_turn"):
+            self._add_timing((event_type, None), event)
+            if event_type == "trace":
+                self.totals["accepted_traces"] += event["status"] == "ok"
+        elif event_type == "stage":
+            self._add_timing(("stage", event["stage"]), event)
+        elif event_type == "llm_call":
+            llm_stage = event.get("llm_stage") or "default"
+            self._add_timing(("llm_call", llm_stage), event)
+            self.llm_tokens[llm_stage]["prompt_tokens"] += event.get("prompt_tokens", 0)
+            self.llm_tokens[llm_stage]["completion_tokens"] += event.get("completion_tokens", 0)
+            for field in ("total_tokens", "retries", "rate_limit_wait_seconds"):
+                self.totals[field] += event.get(field, 0)
+        elif event_type == "truncation":
+            self.totals[f"truncation_{event['action']}"] += 1
+        elif event_type == "self_consistency":
+            self.totals["self_consistency_samples"] += event["samples"]
+            self.totals["self_consistency_agreed"] += event["agreed"]
+        elif event_type in ("pre_validation", "validation"):
+            self.totals[event_type] += 1
+            self.totals[f"{event_type}_failed"] += not event["passed"]
+            self.failed_checks.update(event.get("failed_checks", []))
+        else:
+            self.totals[event_type] += 1
+
+    def _add_timing(self, key: Tuple[str, Optional[str]], event: Dict[str, Any]) -> None:
+        self.timings[key]["seconds"].append(event["seconds"])
+        self.timings[key]["failed"] += event.get("status") == "failed"
+
+    def _timings_by_stage(self, event_type: str) -> Dict[str, Dict[str, Any]]:
+        return {
+            stage: _timing_summary(timing)
+            for (timed_event, stage), timing in self.timings.items()
+            if timed_event == event_type
+        }
+
+    def build(self) -> Dict[str, Any]:
+        llm_summary = {
+            llm_stage: {**timing, **self.llm_tokens[llm_stage]}
+            for llm_stage, timing in self._timings_by_stage("llm_call").items()
+        }
+
+        total_tokens = self.totals["total_tokens"]
+        accepted = self.totals["accepted_traces"]
+
+        return {
+            "traces": _timing_summary(self.timings[("trace", None)]),
+            "stages": self._timings_by_stage("stage"),
+            "llm_calls": llm_summary,
+            "system_turns": _timing_summary(self.timings[("system_turn", None)]),
+            "user_turns": _timing_summary(self.timings[("user_turn", None)]),
+            "total_tokens": total_tokens,
+            # Includes the tokens spent on traces that failed, as these are part of the cost
+            "tokens_per_accepted_trace": total_tokens / accepted if accepted else None,
+            "retries": self.totals["retries"],
+            "rate_limit_wait_seconds": self.totals["rate_limit_wait_seconds"],
+            "cache_hits": self.totals["cache_hit"],
+            "replay_hits": self.totals["replay_hit"],
+            "tag_rules": self.totals["tag_rule"],
+            "truncations": {
+                action: self.totals[f"truncation_{action}"] for action in ("stop", "rollback")
+            },
+            "self_consistency": {
+                "samples": self.totals["self_consistency_samples"],
+                "agreed": self.totals["self_consistency_agreed"],
+            },
+            "pre_validations": {
+                "count": self.totals["pre_validation"],
+                "failed": self.totals["pre_validation_failed"],
+            },
+            "validations": {
+                "count": self.totals["validation"],
+                "failed": self.totals["validation_failed"],
+                "failed_checks": dict(self.failed_checks),
+            },
+        }
+
+
+def summarize(events: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarizes a stream of events, e.g. from iter_events for an earlier run."""
+    builder = _SummaryBuilder()
+    for event in events:
+        builder.add(event)
+    return builder.build()
+
+
+def _format_timing(name: str, timing: Dict[str, Any]) -> str:
+    if not timing["count"]:
+        return f"{name}: none"
+    return (
+        f"{name}: {timing['count']} ({timing['failed']} failed), "
+        f"p50 {timing['p50_seconds']:.2f}s, p95 {timing['p95_seconds']:.2f}s"
+    )
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    lines = [_format_timing("Traces", summary["traces"])]
+    for stage, timing in summary["stages"].items():
+        lines.append("  " + _format_timing(f"Stage {stage}", timing))
+    lines.append(_format_timing("System turns", summary["system_turns"]))
+    lines.append(_format_timing("User turns", summary["user_turns"]))
+    for llm_stage, calls in summary["llm_calls"].items():
+        lines.append(
+            _format_timing(f"LLM calls ({llm_stage})", calls)
+            + f", {calls['prompt_tokens']} prompt / {calls['completion_tokens']} completion tokens"
+        )
+
+    tokens_per_trace = summary["tokens_per_accepted_trace"]
+    lines.append(
+        f"Total tokens: {summary['total_tokens']}"
+        + (f" ({tokens_per_trace:.0f} per accepted trace)" if tokens_per_trace is not None else "")
+    )
+    lines.append(
+        f"Retries: {summary['retries']}, rate limit waits: {summary['rate_limit_wait_seconds']:.1f}s, "
+        f"cache hits: {summary['cache_hits']}, replay hits: {summary['replay_hits']}"
+    )
+    pre_validations = summary["pre_validations"]
+    lines.append(
+        f"Pre-validations: {pre_validations['count']} ({pre_validations['failed']} failed), "
+        f"system turns from tags: {summary['tag_rules']}"
+    )
+    truncations = summary["truncations"]
+    lines.append(
+        f"Conversations stopped after an error: {truncations['stop']}, "
+        f"rollbacks to a checkpoint: {truncations['rollback']}"
+    )
+    self_consistency = summary["self_consistency"]
+    if self_consistency["samples"]:
+        lines.append(
+            f"Self-consistency: {self_consistency['agreed']}/{self_consistency['samples']} "
+            f"validation samples agree with the prediction "
+            f"({self_consistency['agreed'] / self_consistency['samples']:.1%})"
+        )
+    validations = summary["validations"]
+    lines.append(
+        f"Validations: {validations['count']} ({validations['failed']} failed) {validations['failed_checks']}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,123 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""Process-wide rate limiting for LLM requests, shared by all completers of a model."""
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+from lucid_generate_data.modelling_constants import MODEL_RATE_LIMITS
+
+BASE_BACKOFF_SECONDS = 2.0
+MAX_BACKOFF_SECONDS = 60.0
+CHARS_PER_TOKEN = 4
+
+
+class TokenBucket:
+    """A bucket refilled continuously at `per_minute` units per minute.
+
+    Callers reserve units up front, and are told how long to wait before using them.
+    The balance may go negative, which queues later callers behind earlier ones.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self._balance = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._balance = min(self.capacity, self._balance + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Reserves `amount` units, returning the number of seconds to wait before use."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._balance -= min(amount, self.capacity)
+            if self._balance >= 0:
+                return 0.0
+            return -self._balance / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Returns units to the bucket (or takes more, if `amount` is negative)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._balance = min(self.capacity, self._balance + amount)
+
+
+class RateLimiter:
+    """Tracks requests/minute and tokens/minute for a single model."""
+
+    def __init__(
+        self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None
+    ):
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    async def acquire(self, num_tokens: int) -> float:
+        """Waits until a request using `num_tokens` tokens fits the quota.
+
+        Returns the number of seconds spent waiting.
+        """
+        delay = 0.0
+        if self._requests is not None:
+            delay = max(delay, self._requests.reserve(1))
+        if self._tokens is not None:
+            delay = max(delay, self._tokens.reserve(num_tokens))
+
+        with self._lock:
+            delay = max(delay, self._paused_until - time.monotonic())
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+            return delay
+        return 0.0
+
+    def record_usage(self, estimated_tokens: int, used_tokens: int) -> None:
+        """Corrects the token bucket once the real usage of a request is known."""
+        if self._tokens is not None:
+            self._tokens.refund(estimated_tokens - used_tokens)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back all new requests for this model, e.g. after hitting the rate limit."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name: str) -> RateLimiter:
+    """Returns the limiter shared by every request to `model_name` in this process."""
+    with _rate_limiters_lock:
+        if model_name not in _rate_limiters:
+            limits = MODEL_RATE_LIMITS.get(model_name, {})
+            _rate_limiters[model_name] = RateLimiter(
+                requests_per_minute=limits.get("requests_per_minute"),
+                tokens_per_minute=limits.get("tokens_per_minute"),
+            )
+        return _rate_limiters[model_name]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Jittered exponential backoff, which defers to the API's retry-after hint when given."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, 1)
+
+    max_delay = min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2**attempt)
+    return random.uniform(max_delay / 2, max_delay)
@@ -0,0 +1,202 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""Recording and replaying LLM completions, so pipeline runs can be repeated offline.
+
+Completions are keyed by (stage name, prompt, sample index, seed). The sample index
+counts repeated calls with the same prompt within a replay session (e.g. a conversation),
+so that repeated samples are replayed in the order they were recorded.
+
+Modes (set with the LUCID_REPLAY_MODE env variable):
+    off: completions are neither recorded nor replayed
+    record: every completion comes from the API, and is recorded
+    replay: recorded completions are replayed, and only new prompts go to the API
+    offline: recorded completions are replayed, and a missing recording is an error
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+from diskcache import Cache
+
+from lucid_generate_data.utils.metrics import record
+
+if TYPE_CHECKING:
+    from lucid_generate_data.utils.completer import Prompt
+
+REPLAY_MODES = ("off", "record", "replay", "offline")
+REPLAY_MODE = os.environ.get("LUCID_REPLAY_MODE", "off")
+REPLAY_DIR = Path(os.environ.get("LUCID_REPLAY_DIR", "lucid_generate_data/replay"))
+
+
+class ReplayMissingError(ValueError):
+    pass
+
+
+@dataclass
+class ReplaySession:
+    seed: Optional[Any] = None
+    _sample_counts: Dict[Tuple[str, str], int] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def next_sample_index(self, stage_name: str, prompt_json: str, num_samples: int = 1) -> int:
+        """Reserves num_samples consecutive sample indexes, returning the first."""
+        with self._lock:
+            sample_index = self._sample_counts.get((stage_name, prompt_json), 0)
+            self._sample_counts[(stage_name, prompt_json)] = sample_index + num_samples
+        return sample_index
+
+
+_session: ContextVar[Optional[ReplaySession]] = ContextVar("replay_session", default=None)
+
+
+@contextmanager
+def replay_session(seed: Optional[Any] = None) -> Iterator[ReplaySession]:
+    """Groups the completions made inside the block (e.g. for one conversation)."""
+    session = ReplaySession(seed=seed)
+    token = _session.set(session)
+    try:
+        yield session
+    finally:
+        _session.reset(token)
+
+
+class ReplayStore:
+    """Local store of recorded completions."""
+
+    def __init__(self, replay_dir: Path):
+        replay_dir.mkdir(exist_ok=True, parents=True)
+        self._cache = Cache(str(replay_dir))
+
+    def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    def set(self, key: str, completion: str) -> None:
+        self._cache[key] = completion
+
+    def get_count(self, key: str) -> Optional[int]:
+        """The number of completions recorded together from key (see replayed_complete_many)."""
+        return self._cache.get(("count", key))
+
+    def set_count(self, key: str, count: int) -> None:
+        self._cache[("count", key)] = count
+
+
+_store: Optional[ReplayStore] = None
+_store_lock = threading.Lock()
+
+
+def get_replay_store() -> ReplayStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ReplayStore(REPLAY_DIR)
+    return _store
+
+
+def make_replay_key(stage_name: str, prompt_json: str, sample_index: int, seed: Any) -> str:
+    key_data = json.dumps([stage_name, prompt_json, sample_index, seed], default=str)
+    return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+async def replayed_complete(
+    stage_name: Optional[str], prompt: Prompt, complete_fn: Callable[[], Awaitable[str]]
+) -> str:
+    """Replay a recorded completion if there is one, otherwise use complete_fn."""
+    if REPLAY_MODE == "off":
+        return await complete_fn()
+    if REPLAY_MODE not in REPLAY_MODES:
+        raise ValueError(f"Unknown replay mode {REPLAY_MODE}, expected one of {REPLAY_MODES}")
+
+    session = _session.get()
+    if session is None:
+        session = ReplaySession()
+
+    stage_name = stage_name or "default"
+    prompt_json = prompt.json()
+
+    # The sample index is taken before any awaits, so concurrent calls are numbered
+    # .. in the order they are made
+    sample_index = session.next_sample_index(stage_name, prompt_json)
+    key = make_replay_key(stage_name, prompt_json, sample_index, session.seed)
+
+    store = get_replay_store()
+    if REPLAY_MODE in ("replay", "offline"):
+        completion = store.get(key)
+        if completion is not None:
+            record("replay_hit")
+            return completion
+        if REPLAY_MODE == "offline":
+            raise ReplayMissingError(
+                f"No recorded completion for stage {stage_name} (sample {sample_index})"
+            )
+
+    completion = await complete_fn()
+    store.set(key, completion)
+
+    return completion
+
+
+async def replayed_complete_many(
+    stage_name: Optional[str],
+    prompt: Prompt,
+    num_samples: int,
+    complete_fn: Callable[[], Awaitable[List[str]]],
+) -> List[str]:
+    """Replay the completions recorded for num_samples samples, otherwise use complete_fn.
+
+    Each completion is recorded under its own sample index, so samples taken together replay the
+    same as samples taken one at a time. complete_fn can return fewer than num_samples completions
+    (e.g. when some are cut off), so the number returned is recorded too, and exactly that many
+    are replayed.
+    """
+    if REPLAY_MODE == "off":
+        return await complete_fn()
+    if REPLAY_MODE not in REPLAY_MODES:
+        raise ValueError(f"Unknown replay mode {REPLAY_MODE}, expected one of {REPLAY_MODES}")
+
+    session = _session.get()
+    if session is None:
+        session = ReplaySession()
+
+    stage_name = stage_name or "default"
+    prompt_json = prompt.json()
+
+    first_index = session.next_sample_index(stage_name, prompt_json, num_samples)
+    keys = [
+        make_replay_key(stage_name, prompt_json, sample_index, session.seed)
+        for sample_index in range(first_index, first_index + num_samples)
+    ]
+
+    store = get_replay_store()
+    if REPLAY_MODE in ("replay", "offline"):
+        # Samples recorded one at a time have no count, and are replayed if all are recorded
+        count = store.get_count(keys[0])
+        if count is None:
+            count = num_samples
+        completions = [store.get(key) for key in keys[:count]]
+        if all(completion is not None for completion in completions):
+            record("replay_hit")
+            return completions
+        if REPLAY_MODE == "offline":
+            raise ReplayMissingError(
+                f"No recorded completions for stage {stage_name} "
+                f"(samples {first_index} to {first_index + num_samples - 1})"
+            )
+
+    completions = await complete_fn()
+    for key, completion in zip(keys, completions):
+        store.set(key, completion)
+    store.set_count(keys[0], len(completions))
+
+    return completions
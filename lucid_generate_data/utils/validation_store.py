@@ -0,0 +1,122 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+"""A store of validation issues found during generation, in a SQLite database.
+
+Each issue gets a reference (e.[id]) that is saved on the system turn it was found for.
+Ids are allocated by SQLite, so any number of threads and processes can write at once.
+Older runs saved each issue to its own e.[id].json file, which compile_data still reads.
+compile_data is run as a script and imports this module directly, so it only uses the
+standard library.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+VALIDATION_DB_NAME = "validation_issues.sqlite"
+REFERENCE_PREFIX = "e."
+# SQLite limits the number of parameters in a query
+MAX_QUERY_PARAMETERS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    trace_id TEXT,
+    turn_index INTEGER,
+    created REAL NOT NULL,
+    issue TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS issues_by_turn ON issues (trace_id, turn_index);
+"""
+
+
+def make_reference(issue_id: int) -> str:
+    return f"{REFERENCE_PREFIX}{issue_id}"
+
+
+def parse_reference(reference: str) -> int:
+    if not reference.startswith(REFERENCE_PREFIX) or reference.endswith(".json"):
+        raise ValueError(f"{reference} is not a reference to the validation store")
+    return int(reference[len(REFERENCE_PREFIX) :])
+
+
+class ValidationStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        # SQLite connections can't be shared between threads, or carried over into forked processes
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=60)
+            # We use write-ahead logging, so reads are not blocked by concurrent writers
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def save(
+        self,
+        issue: Dict[str, Any],
+        trace_id: Optional[str] = None,
+        turn_index: Optional[int] = None,
+    ) -> str:
+        """Saves an issue, returning its reference."""
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "INSERT INTO issues (trace_id, turn_index, created, issue) VALUES (?, ?, ?, ?)",
+                (trace_id, turn_index, time.time(), json.dumps(issue, default=str)),
+            )
+        return make_reference(cursor.lastrowid)
+
+    def load(self, reference: str) -> Dict[str, Any]:
+        issues = self.load_many([reference])
+        if reference not in issues:
+            raise KeyError(f"No validation issue {reference}")
+        return issues[reference]
+
+    def load_many(self, references: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """The issues for the references, in as few queries as possible (skipping missing ones)."""
+        issue_ids = sorted({parse_reference(reference) for reference in references})
+
+        issues = {}
+        for start in range(0, len(issue_ids), MAX_QUERY_PARAMETERS):
+            chunk = issue_ids[start : start + MAX_QUERY_PARAMETERS]
+            rows = self._connection().execute(
+                f"SELECT id, issue FROM issues WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            issues.update({make_reference(issue_id): json.loads(issue) for issue_id, issue in rows})
+        return issues
+
+    def for_trace(self, trace_id: str) -> List[Dict[str, Any]]:
+        """The issues of a conversation, in turn order."""
+        rows = self._connection().execute(
+            "SELECT id, turn_index, issue FROM issues WHERE trace_id = ? ORDER BY turn_index, id",
+            (trace_id,),
+        )
+        return [
+            {"reference": make_reference(issue_id), "turn_index": turn_index, **json.loads(issue)}
+            for issue_id, turn_index, issue in rows
+        ]
+
+
+_stores: Dict[Path, ValidationStore] = {}
+_lock = threading.Lock()
+
+
+def get_validation_store(folder: str) -> ValidationStore:
+    """Returns the store in a validation issue folder, shared by the whole process."""
+    path = Path(folder) / VALIDATION_DB_NAME
+    with _lock:
+        if path not in _stores:
+            _stores[path] = ValidationStore(path)
+        return _stores[path]
@@ -3,8 +3,20 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
+import json
+import re
+from collections import defaultdict, deque
+from functools import lru_cache
 from os import listdir
 from os.path import isfile, join
+from typing import Any, Dict, List, Tuple
+
+from utils.validation_store import get_validation_store
+
+INTENT_DIRS = ["lucid_v1.0/toolbox_intents", "lucid_v1.0/toolbox_intents_heldout"]
+# Slot references look like x3.slot_name, for the intent called in system turn 3
+SLOT_REFERENCE = re.compile(r"x(0|[1-9][0-9]*)\.")
+MAX_SLOT_REFERENCE_INDEX = 999
 
 STRING_REPLACE_CONVERSATION_INTERRUPTED = [
     "Got to go, let's finish this later",
@@ -103,67 +115,158 @@ def _check_answer_other_slot(turn, last_hint_in_conversation):
     return False
 
 
+class IntentMatcher:
+    """
+    Finds every intent name (as a substring) in an expression, in a single pass (Aho-Corasick)
+    """
+
+    def __init__(self, intents: List[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+
+        for intent in intents:
+            state = 0
+            for char in intent:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._output[state].append(intent)
+
+        # We link each state to the longest suffix that is also a prefix of some intent
+        # .. (states one character deep fail back to the root)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                if state:
+                    self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find(self, expression: str) -> List[Tuple[str, int]]:
+        """
+        All occurrences of intents, as (intent, index after the intent)
+        """
+        matches = []
+        state = 0
+        for position, char in enumerate(expression):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for intent in self._output[state]:
+                matches.append((intent, position + 1))
+
+        return matches
+
+    def intents_in(self, expression: str) -> List[str]:
+        return list(dict.fromkeys(intent for intent, _ in self.find(expression)))
+
+    def intents_called_in(self, expression: str) -> List[str]:
+        return list(
+            dict.fromkeys(
+                intent for intent, end in self.find(expression) if expression[end : end + 1] == "("
+            )
+        )
+
+
+def find_slot_references(expression: str) -> Dict[str, List[str]]:
+    """
+    Slot names assigned through x[index].slot_name references, by index
+    """
+    positions = defaultdict(list)
+    for match in SLOT_REFERENCE.finditer(expression):
+        if int(match.group(1)) < MAX_SLOT_REFERENCE_INDEX:
+            positions[match.group(1)].append(match)
+
+    slot_references = {}
+    for index in sorted(positions, key=int):
+        # We look after each x3. type reference, up to the '=' (we have slotname=....)
+        # .. skipping any further references to the same index before the '='
+        resume_from = 0
+        for match in positions[index]:
+            if match.start() < resume_from:
+                continue
+            end_text = expression.find("=", match.end())
+            if end_text == -1:
+                end_text = len(expression)
+            resume_from = end_text
+
+            command = expression[match.end() : end_text].strip()
+            if command != "":
+                slot_references.setdefault(index, []).append(command)
+
+    return slot_references
+
+
 def _find_slots_now_populated(turn):
     """
     Identify slots that have been populated
     """
     slots_now_populated = {}
 
-    all_intents = find_all_intents_and_query_intents()
+    if get_intent_matcher().intents_called_in(turn["expression"]):
+        split_of_slots = turn["expression"][turn["expression"].find("(") + 1 : -1].split(",")
+        slots_populated = [x[: (x.find("="))].strip() for x in split_of_slots]
+        slots_populated = [x for x in slots_populated if x != ""]
+        slots_now_populated[str(turn["index"])] = slots_populated
 
-    for intent in all_intents:
-        if intent + "(" in turn["expression"]:
-            split_of_slots = turn["expression"][turn["expression"].find("(") + 1 : -1].split(",")
-            slots_populated = [x[: (x.find("="))].strip() for x in split_of_slots]
-            slots_populated = [x for x in slots_populated if x != ""]
-            index = turn["index"]
+    for index, commands in find_slot_references(turn["expression"]).items():
+        slots_now_populated.setdefault(index, []).extend(commands)
 
-            slots_now_populated[str(index)] = slots_populated
+    return slots_now_populated
 
-    for index in range(999):
-        if "x" + str(index) + "." in turn["expression"]:
-            remaining_str = turn["expression"]
 
-            while "x" + str(index) + "." in remaining_str:
-                # Look after x3. type expression to find the slot name...
-                start_text = remaining_str.find("x" + str(index) + ".") + 2 + len(str(index))
-                remaining_str = remaining_str[start_text:]
+@lru_cache(maxsize=None)
+def _list_intents(path: str) -> Tuple[str, ...]:
+    files = [f for f in listdir(path) if isfile(join(path, f))]
+    return tuple(x.replace(".json", "") for x in files)
 
-                # We try looking at the first slot name (we have slotname=...., so we look up to '=')
-                if "=" in remaining_str:
-                    end_text = remaining_str.find("=")
-                else:
-                    end_text = len(remaining_str)
 
-                # Check the slot name
-                command = remaining_str[:end_text].strip()
+def find_all_intents_and_query_intents():
+    # We find all our intents (minus held out intents), and also our heldout intents
+    # .. the directories are only listed once per process
+    all_intents = []
+    for path in INTENT_DIRS:
+        all_intents += _list_intents(path)
 
-                # We create a list of the slots populated in this turn
-                if command != "":
-                    if str(index) not in slots_now_populated:
-                        slots_now_populated[str(index)] = [command]
-                    else:
-                        slots_now_populated[str(index)].append(command)
-                # We continue to iterate through the expression for the turn
-                remaining_str = remaining_str[end_text:]
+    return all_intents
 
-    return slots_now_populated
 
+def find_heldout_intents():
+    return list(_list_intents(INTENT_DIRS[1]))
 
-def find_all_intents_and_query_intents():
-    # We find all our intents (minus held out intents)
-    mypath = "lucid_v1.0/toolbox_intents"
-    files = [f for f in listdir(mypath) if isfile(join(mypath, f))]
 
-    # We also find our heldout intents
-    mypath = "lucid_v1.0/toolbox_intents_heldout"
-    files_heldout = [f for f in listdir(mypath) if isfile(join(mypath, f))]
+@lru_cache(maxsize=None)
+def get_intent_matcher() -> IntentMatcher:
+    return IntentMatcher(find_all_intents_and_query_intents())
 
-    # We outout a list of the intent names
-    all_files = files + files_heldout
-    all_intents = [x.replace(".json", "") for x in all_files]
 
-    return all_intents
+def load_validation_issues(folder: str, references: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Load the validation issues for a list of references, querying the validation store once
+    """
+    issues = {}
+
+    # Older runs saved each issue to its own e.[id].json file
+    store_references = []
+    for reference in references:
+        if reference.endswith(".json"):
+            with open(join(folder, reference), "r") as f:
+                issues[reference] = json.load(f)
+        else:
+            store_references.append(reference)
+
+    if store_references:
+        issues.update(get_validation_store(folder).load_many(store_references))
+
+    return issues
 
 
 def _check_correction(new_slots_populated, slots_already_populated):
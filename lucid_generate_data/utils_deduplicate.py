@@ -0,0 +1,182 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+import hashlib
+import json
+import re
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def canonical_hash(turns: List[Dict[str, Any]]) -> bytes:
+    """
+    A hash of the conversation turns, equal for turns that compare equal
+    """
+    canonical = json.dumps(turns, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).digest()
+
+
+def conversation_shingles(turns: List[Dict[str, Any]], shingle_size: int) -> List[int]:
+    """
+    Hashed word n-grams over the user utterances and system expressions
+    """
+    tokens = []
+    for turn in turns:
+        if turn["author"] == "User":
+            text = turn["query"]
+        elif turn["author"] == "System":
+            text = turn["expression"]
+        else:
+            continue
+        # We mark the turn boundaries, so shingles do not join up unrelated turns
+        tokens += ["|"] + TOKEN_PATTERN.findall(text.lower())
+
+    shingles = {
+        " ".join(tokens[i : i + shingle_size])
+        for i in range(max(1, len(tokens) - shingle_size + 1))
+    }
+    return [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles if shingle]
+
+
+def _false_probabilities(threshold: float, bands: int, rows: int) -> Tuple[float, float]:
+    # The probability two conversations share a band is 1 - (1 - s^rows)^bands, for similarity s
+    below = np.linspace(0.0, threshold, 100)
+    above = np.linspace(threshold, 1.0, 100)
+    false_positive = np.mean(1 - (1 - below**rows) ** bands) * threshold
+    false_negative = np.mean((1 - above**rows) ** bands) * (1 - threshold)
+    return float(false_positive), float(false_negative)
+
+
+def optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    The LSH bands and rows per band, balancing missed and spurious candidates at the threshold
+    """
+    best, best_error = (1, num_perm), float("inf")
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        error = sum(_false_probabilities(threshold, bands, rows))
+        if error < best_error:
+            best, best_error = (bands, rows), error
+
+    return best
+
+
+class Deduplicator:
+    """
+    Streaming removal of exact and near duplicate conversations
+
+    Exact duplicates have identical turns (found by hash). Near duplicates have an estimated Jaccard
+    similarity of at least near_threshold, over shingles of the user utterances and system expressions
+    (found with MinHash and LSH). Memory grows with the kept conversations (a hash and a MinHash
+    signature each), never with their contents.
+    """
+
+    def __init__(
+        self,
+        near_threshold: Optional[float] = 0.9,
+        num_perm: int = 128,
+        shingle_size: int = 3,
+        seed: int = 1,
+    ):
+        self.near_threshold = near_threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, MAX_HASH, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, MAX_HASH, size=num_perm, dtype=np.uint64)
+        if near_threshold is not None:
+            self.bands, self.rows = optimal_bands(near_threshold, num_perm)
+
+        self._exact: Dict[bytes, str] = {}
+        self._buckets: Dict[Tuple[int, int], List[int]] = {}
+        self._signatures: List[np.ndarray] = []
+        self._signature_ids: List[str] = []
+        self._clusters: Dict[str, Dict[str, List[Any]]] = {}
+        self.num_seen = 0
+
+    def _signature(self, turns: List[Dict[str, Any]]) -> Optional[np.ndarray]:
+        shingles = conversation_shingles(turns, self.shingle_size)
+        if not shingles:
+            return None
+
+        hashes = np.array(shingles, dtype=np.uint64)[:, None]
+        permuted = ((hashes * self._a + self._b) % np.uint64(MERSENNE_PRIME)) & np.uint64(MAX_HASH)
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, int]]:
+        return [
+            (band, hash(signature[band * self.rows : (band + 1) * self.rows].tobytes()))
+            for band in range(self.bands)
+        ]
+
+    def _cluster(self, kept_id: str) -> Dict[str, List[Any]]:
+        return self._clusters.setdefault(kept_id, {"exact": [], "near": []})
+
+    def check(self, conversation: Dict[str, Any]) -> bool:
+        """
+        Returns True if the conversation duplicates one already kept, otherwise keeping it
+        """
+        self.num_seen += 1
+        conversation_id = conversation["_id"]
+
+        digest = canonical_hash(conversation["turns"])
+        if digest in self._exact:
+            self._cluster(self._exact[digest])["exact"].append(conversation_id)
+            return True
+
+        signature = None
+        if self.near_threshold is not None:
+            signature = self._signature(conversation["turns"])
+
+        if signature is not None:
+            band_keys = self._band_keys(signature)
+            candidates = {idx for key in band_keys for idx in self._buckets.get(key, [])}
+
+            # We check candidates against their estimated similarity, as sharing a band is not enough
+            for idx in sorted(candidates):
+                similarity = float(np.mean(self._signatures[idx] == signature))
+                if similarity >= self.near_threshold:
+                    self._cluster(self._signature_ids[idx])["near"].append(
+                        [conversation_id, round(similarity, 3)]
+                    )
+                    return True
+
+            for key in band_keys:
+                self._buckets.setdefault(key, []).append(len(self._signatures))
+            self._signatures.append(signature)
+            self._signature_ids.append(conversation_id)
+
+        self._exact[digest] = conversation_id
+        return False
+
+    def deduplicate(self, conversations: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the conversations that are not duplicates, in order
+        """
+        for conversation in conversations:
+            if not self.check(conversation):
+                yield conversation
+
+    def report(self) -> Dict[str, Any]:
+        """
+        The clusters removed, keyed by the id of the conversation kept for each
+        """
+        num_exact = sum(len(cluster["exact"]) for cluster in self._clusters.values())
+        num_near = sum(len(cluster["near"]) for cluster in self._clusters.values())
+        return {
+            "seen": self.num_seen,
+            "kept": self.num_seen - num_exact - num_near,
+            "removed_exact": num_exact,
+            "removed_near": num_near,
+            "near_threshold": self.near_threshold,
+            "clusters": self._clusters,
+        }
@@ -0,0 +1,112 @@
+#
+# For licensing see accompanying LICENSE file.
+# Copyright (C) 2020 Apple Inc. All Rights Reserved.
+#
+
+import gzip
+import hashlib
+import json
+import os
+import textwrap
+from typing import Any, Dict, IO, Optional
+
+MANIFEST_NAME = "manifest.json"
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def _open_for_writing(path: str, compression: Optional[str]) -> IO[str]:
+    if compression == "gzip":
+        return gzip.open(path, "wt", encoding="utf-8")
+    if compression == "zstd":
+        # zstandard is only needed when writing zstd shards
+        import zstandard
+
+        return zstandard.open(path, "wt", encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as rf:
+        for chunk in iter(lambda: rf.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class JsonArrayWriter:
+    """
+    Writes conversations one at a time as a single JSON array (the LUCID_data.json format)
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "w")
+        self.count = 0
+
+    def write(self, conversation: Dict[str, Any]) -> None:
+        # We match the layout of json.dump(conversations, indent=4)
+        self._file.write("[\n" if self.count == 0 else ",\n")
+        self._file.write(textwrap.indent(json.dumps(conversation, indent=4), "    "))
+        self.count += 1
+
+    def close(self) -> None:
+        self._file.write("\n]" if self.count else "[]")
+        self._file.close()
+
+
+class ShardedJsonlWriter:
+    """
+    Writes conversations as JSONL shards per split, with a manifest of the counts and checksums
+    """
+
+    def __init__(self, output_dir: str, compression: Optional[str] = "gzip", shard_size: int = 100000):
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(
+                f"Unknown compression {compression}, expected one of {list(COMPRESSION_SUFFIXES)}"
+            )
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.compression = compression
+        self.shard_size = shard_size
+        self.count = 0
+
+        self._open_shards: Dict[str, Dict[str, Any]] = {}
+        self._manifest: Dict[str, Any] = {"format": "jsonl", "compression": compression, "splits": {}}
+
+    def _close_shard(self, split: str) -> None:
+        shard = self._open_shards.pop(split)
+        shard["file"].close()
+        self._manifest["splits"][split]["shards"].append(
+            {
+                "path": shard["path"],
+                "count": shard["count"],
+                "sha256": file_sha256(os.path.join(self.output_dir, shard["path"])),
+            }
+        )
+
+    def write(self, conversation: Dict[str, Any]) -> None:
+        split = conversation["split"]
+        split_manifest = self._manifest["splits"].setdefault(split, {"count": 0, "shards": []})
+
+        if split in self._open_shards and self._open_shards[split]["count"] >= self.shard_size:
+            self._close_shard(split)
+        if split not in self._open_shards:
+            path = f"{split}-{len(split_manifest['shards']):05d}.jsonl" + COMPRESSION_SUFFIXES[self.compression]
+            self._open_shards[split] = {
+                "path": path,
+                "count": 0,
+                "file": _open_for_writing(os.path.join(self.output_dir, path), self.compression),
+            }
+
+        shard = self._open_shards[split]
+        shard["file"].write(json.dumps(conversation) + "\n")
+        shard["count"] += 1
+        split_manifest["count"] += 1
+        self.count += 1
+
+    def close(self) -> None:
+        for split in list(self._open_shards):
+            self._close_shard(split)
+
+        # The manifest is written last, so its presence marks a complete output
+        with open(os.path.join(self.output_dir, MANIFEST_NAME), "w") as json_file:
+            json.dump(self._manifest, json_file, indent=4)
@@ -3,6 +3,8 @@
 # Copyright (C) 2020 Apple Inc. All Rights Reserved.
 #
 
+from typing import List, Optional
+
 LIST_OF_TAGS_POSSIBLE = [
     "IRRELEVANT",
     "START_MULTI",
@@ -20,6 +22,27 @@ LIST_OF_TAGS_POSSIBLE = [
     "DELAY_CONFIRMATION",
 ]
 
+# Unhappy paths that must be answered with say(), whatever else the user turn contains
+# .. (compile_data imports these as a script, so this module only uses the standard library)
+TAGS_BEFORE_SAY = [
+    "EARLY_END",
+    "IRRELEVANT",
+    "CANCEL",
+    "SARCASTIC",
+    "DELAY_CONFIRMATION",
+    "OVERHEARD",
+]
+
+
+def command_from_tags(tags_extracted: List[str]) -> Optional[str]:
+    """
+    The next system command, if the tags of the last user turn fully determine it
+    """
+    if any(tag in TAGS_BEFORE_SAY for tag in tags_extracted):
+        return "say()"
+
+    return None
+
 
 def validation_from_tags(first_system_command: bool, predicted_response, tags_extracted):
     if "[EARLY_END]" in tags_extracted:
@@ -4,15 +4,65 @@
 #
 
 import datasets
+import gzip
+import hashlib
 import json
+import os
 from sentence_transformers import SentenceTransformer
 from numpy import dot
 from numpy.linalg import norm
 
+LUCID_DATA_PATH = "../lucid_v1.0/LUCID_data.json"
 
-def load_lucid(tokenizer, all_intents, include_tools=False, oracle_bool=True):
-    with open("../lucid_v1.0/LUCID_data.json", "r") as json_file:
-        lucid = json.load(json_file)
+
+def _open_shard(path, compression):
+    if compression == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if compression == "zstd":
+        import zstandard
+
+        return zstandard.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as rf:
+        for chunk in iter(lambda: rf.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def iter_lucid(path=LUCID_DATA_PATH, splits=None, verify=False):
+    """
+    Iterate over the conversations in a LUCID_data.json file, or a directory of JSONL shards
+    (reading the shards lazily, one conversation at a time)
+    """
+    if not os.path.isdir(path):
+        with open(path, "r") as json_file:
+            for conv in json.load(json_file):
+                if splits is None or conv["split"] in splits:
+                    yield conv
+        return
+
+    with open(os.path.join(path, "manifest.json"), "r") as json_file:
+        manifest = json.load(json_file)
+
+    for split, split_manifest in manifest["splits"].items():
+        if splits is not None and split not in splits:
+            continue
+        for shard in split_manifest["shards"]:
+            shard_path = os.path.join(path, shard["path"])
+            if verify and _file_sha256(shard_path) != shard["sha256"]:
+                raise ValueError(f"Checksum mismatch for {shard_path}")
+
+            with _open_shard(shard_path, manifest["compression"]) as rf:
+                for line in rf:
+                    yield json.loads(line)
+
+
+def load_lucid(tokenizer, all_intents, include_tools=False, oracle_bool=True, path=LUCID_DATA_PATH):
+    lucid = iter_lucid(path)
 
     retrieval_model = SentenceTransformer("all-MiniLM-L6-v2")
     if not oracle_bool: